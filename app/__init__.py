@@ -1,11 +1,89 @@
 #/usr/bin/env python
 # -*- coding: utf-8 -*-
+import gc
+import os
+
 import dash
 import dash_bootstrap_components as dbc
 from flask import Flask
 
+try:
+    import uwsgi
+    # Whether the workers are forked after the app has been loaded, which is
+    # what uWSGI does unless it is told to load the app in every worker
+    forks_after_loading = not (uwsgi.opt.get('lazy-apps') or uwsgi.opt.get('lazy'))
+except ImportError:
+    uwsgi = None
+    forks_after_loading = False
+
+# Run a function in every worker after uWSGI forked it (e.g., to start a
+# thread, as threads don't survive the fork), or right away when the app is
+# loaded in the worker itself (uWSGI only runs the hooks which exist when it
+# forks) or when not running under uWSGI
+if forks_after_loading:
+    from uwsgidecorators import postfork
+else:
+    def postfork(function):
+        function()
+        return function
+
 app = Flask(__name__)
 
+# Settings of the atlas, these can be overridden using environment variables
+app.config.update(
+    # 'asset' serves the geometry of the map once as a static, cacheable file
+    # which the figures refer to by URL, 'inline' embeds the geometry in every
+    # figure
+    UBO_GEOJSON_MODE=os.environ.get('UBO_GEOJSON_MODE', 'asset'),
+    # Level of detail of the optimized geometry to use (see LEVELS_OF_DETAIL
+    # in app/geometry.py), if it has been built
+    UBO_GEOMETRY_LOD=os.environ.get('UBO_GEOMETRY_LOD', 'desktop'),
+    # 'server' handles clicks in the category menu with a Dash callback,
+    # 'clientside' sends the data of all categories along with the home page
+    # and lets the browser switch categories without any requests
+    UBO_CALLBACK_ENGINE=os.environ.get('UBO_CALLBACK_ENGINE', 'server'),
+    # Maximum number of Dash responses kept (compressed) in the response cache
+    # of each worker
+    UBO_RESPONSE_CACHE_SIZE=int(os.environ.get('UBO_RESPONSE_CACHE_SIZE', 1024)),
+    # Number of seconds between checks for changed data files, after which the
+    # data is reloaded without restarting the workers; 0 disables reloading
+    UBO_DATA_RELOAD_INTERVAL=float(os.environ.get('UBO_DATA_RELOAD_INTERVAL', 10)),
+    # Check every figure with Plotly's validators when it is built (slow, for
+    # development only)
+    UBO_VALIDATE_FIGURES=os.environ.get('UBO_VALIDATE_FIGURES', '') not in ('', '0'),
+    # Load and warm up the app once in the uWSGI master and freeze it before
+    # the workers are forked, so they share its memory (see app/preload.py)
+    UBO_PRELOAD=os.environ.get('UBO_PRELOAD', '1') not in ('', '0'),
+    # Directory where the uWSGI workers write their metrics (see
+    # app/metrics.py) every UBO_METRICS_INTERVAL seconds, so /metrics can
+    # report those of all workers; empty to only report those of the worker
+    # answering the request
+    UBO_METRICS_DIR=os.environ.get('UBO_METRICS_DIR', '/tmp/ubo-metrics'),
+    UBO_METRICS_INTERVAL=float(os.environ.get('UBO_METRICS_INTERVAL', 5)),
+    # URL of the plotly.js bundle used by the embedded maps (/embed/...);
+    # empty to serve the bundle of the Plotly package as a static file. Any
+    # bundle containing the choropleth trace works, e.g. the smaller 'geo'
+    # partial bundle from the Plotly CDN.
+    UBO_EMBED_PLOTLYJS_URL=os.environ.get('UBO_EMBED_PLOTLYJS_URL', ''),
+    # JSON file defining the atlases served next to the UBO atlas under
+    # their own URL prefix (see app/atlas.py); empty for none
+    UBO_ATLASES=os.environ.get('UBO_ATLASES', ''),
+    # Maximum total size in bytes of the figures of those atlases kept by
+    # each worker
+    UBO_ATLAS_FIGURE_CACHE_BYTES=int(os.environ.get('UBO_ATLAS_FIGURE_CACHE_BYTES', 64 * 1024 * 1024)),
+    # Let browsers cache the bundles, figures and geometry with a service
+    # worker (see app/serviceworker.py); with 0 the service worker removes
+    # itself and its caches from the browsers which installed it
+    UBO_SERVICE_WORKER=os.environ.get('UBO_SERVICE_WORKER', '1') not in ('', '0'),
+)
+
+# While preloading, don't collect garbage until the workers have been forked:
+# objects freed in the master would leave holes in memory pages which are
+# then filled (and so copied) by each worker
+preloading = forks_after_loading and app.config['UBO_PRELOAD']
+if preloading:
+    gc.disable()
+
 external_stylesheets = ['/static/dash.css', dbc.themes.BOOTSTRAP]
 
 dash_app = dash.Dash(__name__, server=app, url_base_pathname="/", external_stylesheets=external_stylesheets)
@@ -64,4 +142,13 @@ dash_app.index_string = '''
 </html>
 '''
 
-from app import routes
+from app import routes, commands, preload
+
+# Warm up the app before it serves requests: once in the uWSGI master when
+# preloading, otherwise in every uWSGI worker when it starts, before it
+# accepts requests (see app/preload.py)
+if preloading:
+    preload.preload()
+    postfork(gc.enable)
+elif uwsgi:
+    postfork(preload.warm_up)
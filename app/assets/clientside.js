@@ -0,0 +1,89 @@
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    ubo: {
+        // The figure with the geometry for small screens if the page is shown
+        // on one: window.uboGeometry (set by interpolate_index in
+        // app/routes.py) maps the URL of the geometry the figures refer to to
+        // the URL of its mobile level of detail, when that has been built
+        for_screen: function(figure) {
+            var geometry = window.uboGeometry;
+            var trace = figure.data[0];
+            if (!geometry || !(trace.geojson in geometry.urls) || !window.matchMedia(geometry.query).matches) {
+                return figure;
+            }
+            return {
+                data: [Object.assign({}, trace, {geojson: geometry.urls[trace.geojson]})].concat(figure.data.slice(1)),
+                layout: figure.layout
+            };
+        },
+
+        // Clientside version of update_home_page in app/routes.py; the last
+        // argument is the data of all categories (see build_category_data),
+        // all others are the n_clicks of the buttons in the category menu
+        update_home_page: function() {
+            var data = arguments[arguments.length - 1];
+            var triggered = dash_clientside.callback_context.triggered;
+            var isOpen = data.categories.map(function() { return false; });
+
+            // Output for the default state when the page is first rendered
+            var match = triggered.length ? /^group-(\d+)-toggle\./.exec(triggered[0].prop_id) : null;
+            if (!match) {
+                return [window.dash_clientside.ubo.for_screen(data.start)].concat(isOpen);
+            }
+
+            // Depending on the clicked category, open that category and show
+            // that map
+            var groupNumber = parseInt(match[1], 10);
+            isOpen[groupNumber] = true;
+            var figure = {
+                data: [Object.assign({}, data.trace, data.categories[groupNumber])],
+                layout: data.layout
+            };
+            return [window.dash_clientside.ubo.for_screen(figure)].concat(isOpen);
+        },
+
+        // Merge a figure update of update_home_page in app/routes.py (see
+        // build_figure_update) into the figure base sent along with the page:
+        // either the whole figure or the trace values of a category
+        update_choropleth: function(update, base) {
+            if (!update) {
+                return window.dash_clientside.no_update;
+            }
+            if (update.figure) {
+                return window.dash_clientside.ubo.for_screen(update.figure);
+            }
+            return window.dash_clientside.ubo.for_screen({
+                data: [Object.assign({}, base.trace, update.trace)],
+                layout: base.layout
+            });
+        },
+
+        // Show the figure updates of update_home_page like update_choropleth,
+        // and apply the changes update_snapshot in app/routes.py sends when
+        // the time slider moves (see build_snapshot_delta) to the figure
+        // currently shown: only the results and tooltips of the countries
+        // listed in 'indexes' are replaced
+        update_home_choropleth: function(update, delta, base, figure) {
+            var ubo = window.dash_clientside.ubo;
+            var triggered = dash_clientside.callback_context.triggered;
+            if (!triggered.length || triggered[0].prop_id !== 'choropleth-delta.data') {
+                return ubo.update_choropleth(update, base);
+            }
+            if (!delta || !figure) {
+                return window.dash_clientside.no_update;
+            }
+            if (delta.trace) {
+                return ubo.update_choropleth(delta, base);
+            }
+            var trace = Object.assign({}, figure.data[0], {
+                z: figure.data[0].z.slice(),
+                text: figure.data[0].text.slice(),
+                colorscale: delta.colorscale
+            });
+            delta.indexes.forEach(function(index, i) {
+                trace.z[index] = delta.z[i];
+                trace.text[index] = delta.text[i];
+            });
+            return {data: [trace], layout: figure.layout};
+        }
+    }
+});
@@ -0,0 +1,8 @@
+// Register the service worker (see app/serviceworker.py), which caches the
+// Dash bundles, the figures and the geometry in the browser so repeat visits
+// and category switches don't need to download them again
+if ('serviceWorker' in navigator) {
+    window.addEventListener('load', function() {
+        navigator.serviceWorker.register('/sw.js').catch(function() {});
+    });
+}
@@ -0,0 +1,219 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app.cache import to_json
+from app.dataset import DataWatcher, load_dataset
+from app.figures import category_figure
+from app.geometry import BUILD_DIR, publish_geojson
+from app.query import StatusIndex, slugify
+
+
+# First segments of the paths of the atlas itself, which can't be used as the
+# prefix of another atlas
+RESERVED_PREFIXES = {'about', 'api', 'assets', 'embed', 'filter', 'metrics', 'ready', 'static'}
+
+
+# Raised when the definitions of the atlases are invalid; lists all problems
+# found instead of only the first one
+class AtlasError(ValueError):
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__('Invalid atlas definitions:\n' + '\n'.join(f'- {x}' for x in problems))
+
+
+# Read the definitions of the atlases served next to the UBO atlas from a JSON
+# file containing a list of atlases like
+#
+#   {
+#       "prefix": "ubo-2020",
+#       "title": "UBO Atlas 2020",
+#       "categories": [{"title": "Paywall", "status": {"no": 1, "yes": 4}, "description": "..."}],
+#       "colors": {"0": "#9AC0D8", "1": "#0BCEAB", "4": "#FF4E4E"},
+#       "data": ["data.csv", "data_tooltips.csv", "data_fields.csv"],
+#       "geometry": "countries.geo.json",
+#       "scope": "europe",
+#       "lat_range": [38, 70],
+#       "lon_range": [-24, 34]
+#   }
+#
+# where the categories are defined like ubo_info in app/routes.py and the data
+# files are the same three CSVs as those of the UBO atlas (see
+# app/dataset.py). Returns the definitions by prefix.
+def load_definitions(path):
+    with open(path) as IN:
+        definitions = json.load(IN)
+
+    problems = []
+    atlases = {}
+    for i, definition in enumerate(definitions):
+        prefix = definition.get('prefix')
+        if not prefix or prefix != slugify(prefix) or prefix in RESERVED_PREFIXES:
+            problems.append(f'atlas {i}: invalid prefix {prefix!r}')
+            continue
+        if prefix in atlases:
+            problems.append(f'{prefix}: duplicate prefix')
+        missing = [key for key in ('title', 'categories', 'colors', 'data', 'geometry') if key not in definition]
+        if missing:
+            problems.append(f'{prefix}: missing {missing}')
+            continue
+        if len(definition['data']) != 3:
+            problems.append(f'{prefix}: expected 3 data files (data, tooltips and data fields)')
+        for path in list(definition['data']) + [definition['geometry']]:
+            if not os.path.exists(path):
+                problems.append(f'{prefix}: {path} does not exist')
+        colors = {int(status): color for status, color in definition['colors'].items()}
+        for category in definition['categories']:
+            unknown = set(category['status'].values()) - set(colors)
+            if unknown:
+                problems.append(f"{prefix}: no colors for status {sorted(unknown)} of '{category['title']}'")
+        atlases[prefix] = dict(definition, colors=colors)
+
+    if problems:
+        raise AtlasError(problems)
+    return atlases
+
+
+# An atlas served next to the UBO atlas under its own URL prefix. Its data is
+# only loaded on the first request for it, and then checked for changes at
+# most every 'reload_interval' seconds (0 never checks again); its figures
+# are kept in the LRU shared by all atlases.
+class Atlas(object):
+    def __init__(self, definition, figures, logger, geojson_mode='asset', reload_interval=0):
+        self.prefix = definition['prefix']
+        self.title = definition['title']
+        self.categories = definition['categories']
+        self.colors = definition['colors']
+        self.data_files = definition['data']
+        self.geometry_file = definition['geometry']
+        self.scope = definition.get('scope', 'europe')
+        self.lat_range = definition.get('lat_range')
+        self.lon_range = definition.get('lon_range')
+        # Compiled dataset, written by `flask compile-data`
+        self.dataset_file = os.path.join(BUILD_DIR, f'atlas-{self.prefix}.json')
+        self.figures = figures
+        self.geojson_mode = geojson_mode
+        self.reload_interval = reload_interval
+        self.logger = logger
+        # Dataset, status index and geometry (or its URL), replaced together
+        # as one tuple; None until the atlas is first used
+        self.state = None
+        self.watcher = None
+        self.last_check = 0
+        self.lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self.state[0].version if self.state else None
+
+    @property
+    def dataset(self):
+        return self.get()[0]
+
+    @property
+    def status_index(self):
+        return self.get()[1]
+
+    def _load(self):
+        # Only fall back to the compiled data when loading the atlas, later
+        # reloads keep the data in use (see get)
+        dataset = load_dataset(
+            self.data_files, self.categories, path=self.dataset_file, logger=self.logger, fallback=self.state is None
+        )
+        if self.state and self.state[0].version == dataset.version:
+            return
+        if self.geojson_mode == 'asset':
+            with open(self.geometry_file, 'rb') as IN:
+                geojson = publish_geojson(IN.read(), name=f'atlas-{self.prefix}')
+        else:
+            with open(self.geometry_file) as IN:
+                geojson = json.load(IN)
+        self.state = (dataset, StatusIndex(dataset, self.categories), geojson)
+        self.logger.info(f'Loaded atlas {self.prefix}, data version {dataset.version}')
+
+    # The loaded state, loading the atlas on first use. Later calls reload
+    # it if its files changed; invalid data is logged and the previous data
+    # stays in use.
+    def get(self):
+        if self.state is None:
+            with self.lock:
+                if self.state is None:
+                    self.watcher = DataWatcher(
+                        self.data_files + [self.dataset_file, self.geometry_file], 0, self._load, self.logger
+                    )
+                    self._load()
+                    self.last_check = time.monotonic()
+        elif self.reload_interval and time.monotonic() - self.last_check > self.reload_interval:
+            with self.lock:
+                if time.monotonic() - self.last_check > self.reload_interval:
+                    self.last_check = time.monotonic()
+                    try:
+                        self.watcher.check()
+                    except Exception:
+                        self.logger.exception(f'Reloading atlas {self.prefix} failed')
+        return self.state
+
+    # The figure of a category serialized to JSON
+    def figure_json(self, category):
+        return self.figures.get(self, category)
+
+    # The figure of a category of a state returned by get()
+    def build_figure(self, state, category):
+        dataset, _, geojson = state
+        return category_figure(
+            dataset, category, geojson, self.colors, self.lat_range, self.lon_range, scope=self.scope
+        )
+
+
+# The figures of all atlases, serialized to JSON (which is ASCII, so a
+# character takes a byte), in one LRU bounded by the total size of the
+# figures instead of their number, so the memory they take stays predictable
+# however many atlases are served (figures with inline geometry are a lot
+# larger than those referring to it by URL). The least recently used figures
+# are evicted and rebuilt when they are needed again.
+class FigureLRU(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # Serialized figures by (prefix, data version, category)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, atlas, category):
+        state = atlas.get()
+        key = (atlas.prefix, state[0].version, category)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        self.misses += 1
+        entry = to_json(atlas.build_figure(state, category))
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = entry
+                self.bytes += len(entry)
+            # Always keep the figure just built, even if it is larger than
+            # the limit on its own
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+        return entry
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
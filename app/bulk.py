@@ -0,0 +1,112 @@
+import csv
+import io
+import json
+import threading
+
+from app.query import slugify
+from app.responses import CachedResponse
+
+
+# Formats the whole dataset is served in and their media types
+FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# Columns of the CSV, which has a row per country and category
+CSV_COLUMNS = ['country_code', 'country', 'category', 'category_title', 'result', 'result_slug', 'status', 'tooltip']
+
+
+# The categories of a dataset (see StatusIndex in app/query.py) with their
+# slugs and the results which can be used in queries
+def category_list(index, categories):
+    return [
+        {
+            'slug': slug,
+            'title': category['title'],
+            'results': [
+                {'slug': result_slug, 'result': result, 'status': category['status'][result]}
+                for result_slug, (result, _) in results.items()
+            ],
+        } for slug, category, results in zip(index.slugs, categories, index.results)
+    ]
+
+
+# The dataset joined per country: its code, name and per category (by slug)
+# the result, its slug, status code and tooltip
+def country_records(index):
+    dataset = index.dataset
+    return [
+        {
+            'code': code,
+            'name': name,
+            'results': {
+                slug: {
+                    'result': category['values'][i],
+                    'slug': slugify(category['values'][i]),
+                    'status': category['status'][i],
+                    'tooltip': category['tooltips'][i],
+                } for slug, category in zip(index.slugs, dataset.categories)
+            },
+        } for i, (code, name) in enumerate(zip(dataset.codes, dataset.names))
+    ]
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+# The bodies of the dataset in all formats: one JSON document with the version
+# and the categories, one JSON record per country per line, and a CSV with a
+# row per country and category
+def render_dataset(index, categories):
+    records = country_records(index)
+    titles = dict(zip(index.slugs, (x['title'] for x in categories)))
+
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(CSV_COLUMNS)
+    for record in records:
+        for slug, result in record['results'].items():
+            writer.writerow([
+                record['code'], record['name'], slug, titles[slug],
+                result['result'], result['slug'], result['status'], result['tooltip']
+            ])
+
+    return {
+        'json': _dumps({'version': index.version, 'categories': category_list(index, categories), 'countries': records}),
+        'ndjson': ''.join(_dumps(record) + '\n' for record in records),
+        'csv': out.getvalue(),
+    }
+
+
+# The responses of the whole dataset in all formats, rendered and compressed
+# (see app/responses.py) once per data version when first requested, so every
+# later request is answered from memory, or with a 304 if the client already
+# has the current version
+class DatasetExports(object):
+    def __init__(self):
+        # Data version and responses by format, replaced together as one tuple
+        self.state = (None, {})
+        self.lock = threading.Lock()
+
+    def get(self, index, categories, format):
+        version, responses = self.state
+        if version != index.version:
+            with self.lock:
+                version, responses = self.state
+                if version != index.version:
+                    responses = {
+                        name: CachedResponse(body.encode('utf-8'), FORMATS[name], 'no-cache')
+                        for name, body in render_dataset(index, categories).items()
+                    }
+                    self.state = (index.version, responses)
+        return responses[format]
+
+    def stats(self):
+        version, responses = self.state
+        return {
+            'version': version,
+            'bytes': {name: response.size for name, response in responses.items()},
+        }
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import threading
+
+import plotly
+
+
+# Version of a dataset, i.e. the SHA-1 of the combined contents of all the
+# files it is made of and of any extra strings (e.g., versions of other parts
+# of the data); any change to one of them results in a new version
+def data_version(paths, *extra):
+    sha1 = hashlib.sha1()
+    for value in extra:
+        sha1.update(value.encode('utf-8'))
+    for path in paths:
+        with open(path, 'rb') as IN:
+            sha1.update(IN.read())
+    return sha1.hexdigest()
+
+
+# Serialize an object the same way as Dash serializes callback output
+def to_json(obj):
+    return json.dumps(obj, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+# Cache holding the finished figures (or page layouts) of one data version.
+# Each entry is only kept as the serialized figure in a bytes object, which
+# is decoded into plain dicts/lists when requested (so Dash only has to
+# serialize builtin types again instead of validated Plotly objects or
+# component trees). Unlike a tree of Python objects, whose reference counts
+# change whenever it is used, the bytes are never written to, so workers
+# forked after the cache was loaded share its memory with the master.
+class SerializedCache(object):
+    def __init__(self, build):
+        # Function returning the object for a key, e.g. update_choropleth
+        self.build = build
+        # Data version and entries, replaced together as one tuple
+        self.state = (None, {})
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self.state[0]
+
+    @property
+    def entries(self):
+        return self.state[1]
+
+    # (Re)build the figures of all keys for a data version. If 'changed' is
+    # given only the figures of those keys are rebuilt and the others are
+    # taken over from the current version. The entries are swapped in one go
+    # so concurrent lookups never see a mix of versions.
+    def load(self, version, keys, changed=None):
+        with self.lock:
+            current = self.entries
+            entries = {}
+            for key in keys:
+                if changed is not None and key not in changed and key in current:
+                    entries[key] = current[key]
+                else:
+                    entries[key] = self._build_entry(key)
+            self.state = (version, entries)
+
+    def _build_entry(self, key):
+        return to_json(self.build(key)).encode('utf-8')
+
+    def _entry(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        # Only happens for keys that were not passed to load()
+        self.misses += 1
+        with self.lock:
+            version, entries = self.state
+            entry = self._build_entry(key)
+            entries = dict(entries)
+            entries[key] = entry
+            self.state = (version, entries)
+        return entry
+
+    # Return the figure for a key as plain dicts/lists
+    def get(self, key):
+        return json.loads(self._entry(key))
+
+    # Return the figure for a key serialized to JSON
+    def get_json(self, key):
+        return self._entry(key).decode('utf-8')
+
+    def stats(self):
+        version, entries = self.state
+        return {
+            'version': version,
+            'size': len(entries),
+            'bytes': sum(len(x) for x in entries.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
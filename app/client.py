@@ -0,0 +1,133 @@
+from dash._utils import create_callback_id
+from dash.dependencies import Input, Output, State
+
+from app import dash_app, routes
+from app.bulk import FORMATS
+
+
+# Paths of the Dash endpoints
+LAYOUT_PATH = dash_app.config.routes_pathname_prefix + '_dash-layout'
+DEPENDENCIES_PATH = dash_app.config.routes_pathname_prefix + '_dash-dependencies'
+UPDATE_COMPONENT_PATH = dash_app.config.routes_pathname_prefix + '_dash-update-component'
+
+
+# Body of a request to the callback endpoint, the same as dash-renderer sends
+# when the inputs in 'changed' (e.g., ['url.pathname']) triggered a callback.
+# Like dash-renderer (which serializes undefined values by leaving them out)
+# inputs without a value and the state of callbacks without State are left
+# out, so the bodies are equal to those of browsers after normalization.
+def callback_body(outputs, inputs, values, changed, state=(), state_values=()):
+    if isinstance(outputs, list):
+        outputs_list = [{'id': x.component_id, 'property': x.component_property} for x in outputs]
+    else:
+        outputs_list = {'id': outputs.component_id, 'property': outputs.component_property}
+    body = {
+        'output': create_callback_id(outputs),
+        'outputs': outputs_list,
+        'inputs': [x.to_dict() if value is None else dict(x.to_dict(), value=value) for x, value in zip(inputs, values)],
+        'changedPropIds': changed,
+    }
+    if state:
+        body['state'] = [
+            x.to_dict() if value is None else dict(x.to_dict(), value=value) for x, value in zip(state, state_values)
+        ]
+    return body
+
+
+# Request of display_page for a path
+def display_page_body(pathname):
+    return callback_body(Output('page-content', 'children'), [Input('url', 'pathname')], [pathname], ['url.pathname'])
+
+
+# Request of update_home_page for a category, or 'start' for the request made
+# when the home page is first rendered, with the time slider at a snapshot
+# (by default the current data); 'clicks' are the n_clicks of the buttons of
+# all categories, as the browser sends them (by default only the category was
+# clicked, once)
+def home_page_body(key, snapshot=None, clicks=None):
+    if key == 'start':
+        values, changed = [None] * len(routes.home_page_inputs), []
+    else:
+        values = clicks or [1 if x == key else None for x in range(0, len(routes.home_page_inputs))]
+        changed = [f'group-{key}-toggle.n_clicks']
+    if snapshot is None:
+        snapshot = len(routes.snapshot_datasets) - 1
+    return callback_body(
+        routes.home_page_outputs, routes.home_page_inputs, values, changed,
+        [State('snapshot-slider', 'value')], [snapshot]
+    )
+
+
+# Request of update_snapshot when the time slider moves from one snapshot to
+# another while a category is shown
+def snapshot_body(source, target, category):
+    is_open = [x == category for x in range(0, len(routes.ubo_info))]
+    return callback_body(
+        routes.snapshot_outputs, routes.snapshot_inputs, [target], ['snapshot-slider.value'],
+        routes.snapshot_states, [source] + is_open
+    )
+
+
+# Request of update_filter_map for the results (slugs) selected per category,
+# as made when the filter page is first rendered if no results are given
+def filter_page_body(selected=None):
+    selected = selected or {}
+    values = [selected.get(i) for i in range(0, len(routes.filter_inputs))]
+    changed = [f'filter-{i}.value' for i in sorted(selected)]
+    return callback_body(routes.filter_page_outputs, routes.filter_inputs, values, changed)
+
+
+# Whether update_home_page runs on the server (i.e. not with the clientside
+# engine)
+def home_page_on_server():
+    return create_callback_id(routes.home_page_outputs) in dash_app.callback_map
+
+
+# All requests the pages make to the Dash endpoints, as (name, method, path,
+# JSON body) tuples
+def dash_requests():
+    requests = [
+        ('layout', 'GET', LAYOUT_PATH, None),
+        ('dependencies', 'GET', DEPENDENCIES_PATH, None),
+        ('display_page /', 'POST', UPDATE_COMPONENT_PATH, display_page_body('/')),
+        ('display_page /about', 'POST', UPDATE_COMPONENT_PATH, display_page_body('/about')),
+        ('display_page /filter', 'POST', UPDATE_COMPONENT_PATH, display_page_body('/filter')),
+        ('update_filter_map', 'POST', UPDATE_COMPONENT_PATH, filter_page_body()),
+    ]
+    if home_page_on_server():
+        for key in ['start'] + list(range(0, len(routes.ubo_info))):
+            requests.append((f'update_home_page {key}', 'POST', UPDATE_COMPONENT_PATH, home_page_body(key)))
+        # Moving the time slider back one snapshot and forward again
+        latest = len(routes.snapshot_datasets) - 1
+        if latest:
+            for category in range(0, len(routes.ubo_info)):
+                for source, target in ((latest, latest - 1), (latest - 1, latest)):
+                    requests.append((
+                        f'update_snapshot {category} {source}-{target}', 'POST', UPDATE_COMPONENT_PATH,
+                        snapshot_body(source, target, category)
+                    ))
+    return requests
+
+
+# Requests of a visitor clicking through the category menu: 'count' clicks
+# going around the categories (skipping some, so the same category isn't
+# always clicked after the same other one), with the click counts growing
+# like in the browser
+def click_requests(count):
+    clicks = [None] * len(routes.ubo_info)
+    requests = []
+    for i in range(0, count):
+        key = (i * 3) % len(routes.ubo_info)
+        clicks[key] = (clicks[key] or 0) + 1
+        requests.append((f'click {i}', 'POST', UPDATE_COMPONENT_PATH, home_page_body(key, clicks=list(clicks))))
+    return requests
+
+
+# Requests of the embedded maps of all categories
+def embed_requests():
+    return [(f'embed {slug}', 'GET', f'/embed/{slug}', None) for slug in routes.status_index.slugs]
+
+
+# Requests of the whole dataset in all formats
+def dataset_requests():
+    return [(f'dataset {name}', 'GET', f'/api/v1/dataset.{name}', None) for name in FORMATS]
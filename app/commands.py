@@ -0,0 +1,126 @@
+import datetime
+import importlib.util
+import os
+import subprocess
+import sys
+
+import click
+
+from app import app, routes
+from app.dataset import DatasetError, write_dataset
+from app.export import EXPORT_DIR, export_site
+from app.geometry import build_geometry
+from app.images import IMAGE_DIR, render_images
+from app.snapshots import SNAPSHOTS_FILE, append_snapshot
+
+
+# Validate the CSVs and compile them into the single data file loaded by the
+# workers (see app/dataset.py); invalid data is reported here instead of
+# failing in a live request. New data is also recorded as a snapshot in the
+# history shown by the time slider (see app/snapshots.py).
+@app.cli.command('compile-data')
+@click.option('--date', default=lambda: datetime.date.today().isoformat(), show_default='today',
+              help='Date of the data, shown on the time slider.')
+def compile_data_command(date):
+    try:
+        compiled = write_dataset(
+            [routes.DATA_FILE, routes.DATA_TOOLTIPS_FILE, routes.DATA_FIELDS_FILE],
+            routes.ubo_info
+        )
+    except DatasetError as e:
+        raise click.ClickException(str(e))
+    click.echo(
+        f"Compiled {len(compiled['countries'])} countries and {len(compiled['categories'])} "
+        f"categories, version {compiled['version']}"
+    )
+    if append_snapshot(compiled, date):
+        click.echo(f'Recorded the data as the snapshot of {date} in {SNAPSHOTS_FILE}')
+
+    # The atlases served next to the UBO atlas (see app/atlas.py)
+    for prefix, atlas in routes.atlases.items():
+        try:
+            compiled = write_dataset(atlas.data_files, atlas.categories, path=atlas.dataset_file)
+        except DatasetError as e:
+            raise click.ClickException(f'{prefix}: {e}')
+        click.echo(
+            f"Compiled {len(compiled['countries'])} countries and {len(compiled['categories'])} "
+            f"categories of atlas {prefix}, version {compiled['version']}"
+        )
+
+
+# Build the optimized geometry files in data/build from the source GeoJSON,
+# only containing the countries in the data and the part of the world shown
+# on the map
+@app.cli.command('build-geometry')
+@click.option('--topojson', is_flag=True, help='Also write TopoJSON files.')
+def build_geometry_command(topojson):
+    report = build_geometry(
+        routes.GEOJSON_SOURCE_FILE,
+        routes.dataset.codes,
+        (routes.LON_RANGE[0], routes.LAT_RANGE[0], routes.LON_RANGE[1], routes.LAT_RANGE[1]),
+        topojson=topojson
+    )
+    source_size = report[0][1]
+    for stage, size in report:
+        click.echo(f'{stage:<20} {size:>10,} bytes  {size / source_size:>6.1%}')
+
+
+# Render the images of the maps (the start map and one per category) used as
+# og:image and as placeholders while the interactive maps load (see
+# app/images.py); only maps whose figure changed are rendered again, so run
+# this after every data change. The workers pick up the new images by
+# themselves.
+@app.cli.command('render-maps')
+def render_maps_command():
+    if importlib.util.find_spec('kaleido') is None:
+        raise click.ClickException('Rendering the maps requires the kaleido package: pip install kaleido')
+    keys = ['start'] + list(range(0, len(routes.ubo_info)))
+    rendered = render_images(
+        {routes.map_name(key): routes.figure_cache.get_json(key) for key in keys},
+        routes.GEOJSON_FILE
+    )
+    click.echo(f'Rendered {len(rendered)} of {len(keys)} maps of version {routes.dataset.version} to {IMAGE_DIR}')
+
+
+# Export the atlas as a static site which nginx can serve on its own (see
+# docker/docker-compose-static.yml); tests/test_export.py checks that the
+# exported home page shows the data
+@app.cli.command('export')
+@click.option('--output', default=EXPORT_DIR, show_default=True, help='Directory to export to.')
+def export_command(output):
+    manifest = export_site(output)
+    click.echo(
+        f"Exported {len(manifest['pages'])} pages and {len(manifest['figures'])} figures "
+        f"of version {manifest['version']} to {output}"
+    )
+
+
+# Report which modules take the most time to import in a fresh interpreter
+# importing app.routes, as a uWSGI worker does when it starts, using Python's
+# -X importtime
+@app.cli.command('import-report')
+@click.option('--limit', default=20, show_default=True, help='Number of modules to list.')
+def import_report_command(limit):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app.routes'],
+        env=dict(os.environ, UBO_DATA_RELOAD_INTERVAL='0'),
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    if result.returncode:
+        raise click.ClickException(f'Importing app.routes failed:\n{result.stderr}')
+
+    # Lines look like 'import time:  self [us] | cumulative | imported package'
+    # with the package indented by its depth in the import tree
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((int(self_us), int(cumulative_us), name.strip()))
+
+    click.echo(f"{'self':>10} {'cumulative':>12}  module")
+    for self_us, cumulative_us, name in sorted(modules, reverse=True)[:limit]:
+        click.echo(f'{self_us / 1000:>8.1f}ms {cumulative_us / 1000:>10.1f}ms  {name}')
+    total = sum(self_us for self_us, _, _ in modules)
+    click.echo(f'Imported {len(modules)} modules in {total / 1000:.1f}ms')
@@ -0,0 +1,238 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from app.files import atomic_write
+
+
+# Title of the category whose results and tooltips come from the data fields
+# CSV instead of the main data and tooltips CSVs
+DATA_FIELDS_TITLE = 'Data fields'
+
+# Columns of the data fields CSV which are shown in the tooltips
+DATA_FIELDS = [
+    'Name',
+    'Month and year of birth',
+    'Country of residence',
+    'Nationality',
+    'Nature of interest',
+    'Extent of interest',
+    'Additional information',
+]
+
+# Compiled dataset written by `flask compile-data`
+DATASET_FILE = 'data/build/ubo_atlas.json'
+
+
+# Raised when the CSVs don't match the category definitions; lists all
+# problems found instead of only the first one
+class DatasetError(ValueError):
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__('Invalid data:\n' + '\n'.join(f'- {x}' for x in problems))
+
+
+def _read_csv(path):
+    with open(path) as IN:
+        return list(csv.DictReader(IN))
+
+
+# Version of the sources of a dataset: the CSVs and the category definitions,
+# as a change in either results in a different dataset
+def source_version(paths, categories):
+    sha1 = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as IN:
+            sha1.update(IN.read())
+    sha1.update(json.dumps([[x['title'], x['status']] for x in categories]).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+# Index rows by country code, or by country name for CSVs without codes
+def _index_rows(rows, name, codes_by_country, problems):
+    index = {}
+    for row in rows:
+        if 'Country code' in row:
+            code = row['Country code']
+        else:
+            code = codes_by_country.get(row.get('Country'))
+        if code is None:
+            problems.append(f"{name}: unknown country '{row.get('Country')}'")
+        elif code in index:
+            problems.append(f"{name}: duplicate row for {code}")
+        else:
+            index[code] = row
+    return index
+
+
+# Validate the CSVs against the category definitions and join them by country
+# code into one dataset containing per category an array of results, status
+# codes and tooltips in the order of the country index
+def compile_dataset(data_file, tooltips_file, fields_file, categories):
+    problems = []
+    data = _read_csv(data_file)
+    tooltips = _read_csv(tooltips_file)
+    fields = _read_csv(fields_file)
+
+    countries = []
+    codes = set()
+    codes_by_country = {}
+    for row in data:
+        code, name = row.get('Country code'), row.get('Country')
+        if not code or not name:
+            problems.append(f"data: row without 'Country' or 'Country code': {row}")
+        elif code in codes:
+            problems.append(f"data: duplicate row for {code}")
+        else:
+            codes.add(code)
+            codes_by_country[name] = code
+            countries.append({'code': code, 'name': name})
+    data = _index_rows(data, 'data', codes_by_country, problems)
+    tooltips = _index_rows(tooltips, 'tooltips', codes_by_country, problems)
+    fields = _index_rows(fields, 'data fields', codes_by_country, problems)
+
+    compiled = []
+    for category in categories:
+        title = category['title']
+        values, status, texts = [], [], []
+        for country in countries:
+            code = country['code']
+            if title == DATA_FIELDS_TITLE:
+                row = fields.get(code)
+                value = row and row.get('Ranking')
+                tooltip = row and ''.join(f'{x}: {row.get(x)}<br>' for x in DATA_FIELDS)
+            else:
+                value = data.get(code, {}).get(title)
+                tooltip = tooltips.get(code, {}).get(title)
+
+            if value is None:
+                problems.append(f"{title}: no result for {code}")
+            elif value not in category['status']:
+                problems.append(
+                    f"{title}: unknown result '{value}' for {code}, expected one of {list(category['status'])}"
+                )
+            if tooltip is None:
+                problems.append(f"{title}: no tooltip for {code}")
+
+            values.append(value)
+            status.append(category['status'].get(value))
+            texts.append(tooltip)
+
+        compiled.append({'title': title, 'values': values, 'status': status, 'tooltips': texts})
+
+    if problems:
+        raise DatasetError(problems)
+
+    dataset = {'countries': countries, 'categories': compiled}
+    dataset['version'] = hashlib.sha1(json.dumps(dataset, sort_keys=True).encode('utf-8')).hexdigest()
+    return dataset
+
+
+# The compiled data shown in the atlas; countries are referred to by their
+# position in the country index, which is the order of the main data CSV
+class Dataset(object):
+    def __init__(self, compiled):
+        self.version = compiled['version']
+        self.countries = compiled['countries']
+        self.codes = [x['code'] for x in self.countries]
+        self.names = [x['name'] for x in self.countries]
+        self.index = {code: i for i, code in enumerate(self.codes)}
+        self.categories = compiled['categories']
+        # Per category a hash of everything shown in its map, used to find
+        # the categories which changed between two datasets
+        self.fingerprints = [
+            hashlib.sha1(json.dumps([self.countries, x], sort_keys=True).encode('utf-8')).hexdigest()
+            for x in self.categories
+        ]
+
+    # Indexes of the categories whose data differs from another dataset
+    def changed_categories(self, other):
+        return [
+            i for i, (old, new) in enumerate(zip(other.fingerprints, self.fingerprints)) if old != new
+        ]
+
+
+# Compile the CSVs and write the result, together with the version of its
+# sources, to a single JSON file
+def write_dataset(paths, categories, path=DATASET_FILE):
+    compiled = compile_dataset(*paths, categories)
+    compiled['source_version'] = source_version(paths, categories)
+    atomic_write(path, json.dumps(compiled, separators=(',', ':')))
+    return compiled
+
+
+# Load the compiled dataset, or compile it from the CSVs if it hasn't been
+# compiled yet or if the CSVs or categories changed since it was compiled.
+# When starting ('fallback'), invalid CSVs are logged and the dataset compiled
+# last is used instead, so workers still start until the CSVs are fixed;
+# otherwise, and without a compiled dataset, the DatasetError is raised (a
+# running worker keeps the data it has, which may be newer than that file).
+def load_dataset(paths, categories, path=DATASET_FILE, logger=None, fallback=True):
+    compiled = None
+    if os.path.exists(path):
+        with open(path) as IN:
+            compiled = json.load(IN)
+        if compiled.get('source_version') == source_version(paths, categories):
+            return Dataset(compiled)
+    try:
+        return Dataset(compile_dataset(*paths, categories))
+    except DatasetError as e:
+        if compiled is None or not fallback:
+            raise
+        (logger or logging.getLogger(__name__)).error(f"{e}\nUsing the data compiled last, version {compiled['version']}")
+        return Dataset(compiled)
+
+
+# A dataset without any countries, for when there is no data at all
+def empty_dataset(categories):
+    compiled = {
+        'countries': [],
+        'categories': [{'title': x['title'], 'values': [], 'status': [], 'tooltips': []} for x in categories],
+    }
+    compiled['version'] = hashlib.sha1(json.dumps(compiled, sort_keys=True).encode('utf-8')).hexdigest()
+    return Dataset(compiled)
+
+
+# Polls the data files in a background thread and calls 'on_change' when one
+# of them is modified, added or removed. Errors (e.g., invalid data) are
+# logged and don't stop the watcher, so the current data stays in use until
+# the files are fixed.
+class DataWatcher(object):
+    def __init__(self, paths, interval, on_change, logger):
+        self.paths = paths
+        self.interval = interval
+        self.on_change = on_change
+        self.logger = logger
+        self.last = self._stat()
+
+    def _stat(self):
+        stats = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stats.append(None)
+        return stats
+
+    def check(self):
+        current = self._stat()
+        if current != self.last:
+            self.last = current
+            self.on_change()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                self.logger.exception('Reloading the data failed')
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='data-watcher', daemon=True)
+        thread.start()
@@ -0,0 +1,150 @@
+import os
+import re
+
+import plotly
+from flask import render_template_string
+from markupsafe import Markup
+
+from app.files import atomic_write
+from app.geometry import SMALL_SCREEN_QUERY
+
+
+# Directory and URL of the plotly.js bundle used by the embedded maps, served
+# by nginx
+EMBED_DIR = 'app/static/embed'
+EMBED_URL = '/static/embed/'
+
+# The plotly.js bundle of the Plotly package
+PLOTLYJS_BUNDLE = os.path.join(os.path.dirname(plotly.__file__), 'package_data', 'plotly.min.js')
+
+
+# Version of the plotly.js bundle, from the comment it starts with; unlike
+# plotly.offline.get_plotlyjs_version this doesn't import plotly.offline,
+# which imports IPython (if installed) and slows down starting a worker
+def plotlyjs_version():
+    with open(PLOTLYJS_BUNDLE) as IN:
+        return re.search(r'plotly\.js v(\S+)', IN.read(256)).group(1)
+
+
+# Copy the plotly.js bundle to a static file whose name contains its version,
+# so browsers and nginx can cache it forever, and return its URL
+def publish_plotlyjs():
+    filename = f'plotly-{plotlyjs_version()}.min.js'
+    path = os.path.join(EMBED_DIR, filename)
+
+    # Every uWSGI worker may run this, so copy it atomically
+    if not os.path.exists(path):
+        with open(PLOTLYJS_BUNDLE, 'rb') as IN:
+            atomic_write(path, IN.read())
+
+    return EMBED_URL + filename
+
+
+# A page with only the map of one category, its legend and a link to the
+# atlas, drawn by plotly.js from the figure in the page itself. If the map
+# has been prerendered (see app/images.py) its image is shown until plotly.js
+# has drawn the map, and to clients without JavaScript.
+EMBED_TEMPLATE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <title>{{ title }} - {{ atlas_title }}</title>
+    <meta property="og:title" content="{{ title }} - {{ atlas_title }}">
+    <meta property="og:image" content="{{ image.png if image else '/static/UBO_Atlas_og.png' }}">
+    <style>
+        html, body { height: 100%; margin: 0; }
+        body { display: flex; flex-direction: column; background-color: #FFF0E6; color: #002346; font-family: 'Mulish', sans-serif; }
+        h1 { font-size: 18px; margin: 8px; }
+        #map { flex: 1; min-height: 0; position: relative; }
+        #placeholder img { position: absolute; width: 100%; height: 100%; object-fit: contain; }
+        .legend, footer { font-size: 14px; margin: 4px 8px; }
+        .legend span { display: inline-block; width: 12px; height: 12px; margin: 0 4px 0 8px; vertical-align: middle; }
+        a { color: #002346; }
+    </style>
+</head>
+<body>
+    <h1>{{ title }}</h1>
+    <div id="map">
+        {% if image %}<picture id="placeholder"><source type="image/webp" srcset="{{ image.webp }}"><img src="{{ image.png }}" alt="Map of {{ title }}"></picture>{% endif %}
+    </div>
+    <div class="legend">
+        {% for value, color in legend %}<span style="background-color: {{ color }}"></span>{{ value }}{% endfor %}
+    </div>
+    <footer>Source: <a href="{{ atlas_url }}" target="_blank" rel="noopener">{{ atlas_title }}</a></footer>
+    <script src="{{ plotlyjs_url }}"></script>
+    <script>
+        var figure = {{ figure }};
+        // The geometry for small screens, see for_screen in app/assets/clientside.js
+        var smallScreenGeometry = {{ small_screen_geometry|tojson }};
+        if (figure.data[0].geojson in smallScreenGeometry && window.matchMedia({{ small_screen_query|tojson }}).matches) {
+            figure.data[0].geojson = smallScreenGeometry[figure.data[0].geojson];
+        }
+        Plotly.newPlot('map', figure.data, figure.layout, {displayModeBar: false, responsive: true, scrollZoom: false}).then(function () {
+            var placeholder = document.getElementById('placeholder');
+            if (placeholder) {
+                placeholder.remove();
+            }
+        });
+    </script>
+</body>
+</html>
+'''
+
+
+# Render the embed page of a category; 'figure' is the figure serialized to
+# JSON, 'legend' a list of (result, color) pairs and 'image' the entry of the
+# map in the image manifest, if any. The page links to the atlas at
+# 'atlas_url'. On small screens the page loads the geometry whose URL
+# 'small_screen_geometry' maps the URL in the figure to, if any.
+def render_embed(title, figure, legend, plotlyjs_url, image=None, atlas_title='UBO Atlas', atlas_url='/',
+                 small_screen_geometry=None):
+    return render_template_string(
+        EMBED_TEMPLATE,
+        title=title,
+        atlas_title=atlas_title,
+        atlas_url=atlas_url,
+        # Keep the figure from closing the script element
+        figure=Markup(figure.replace('</', '<\\/')),
+        legend=legend,
+        plotlyjs_url=plotlyjs_url,
+        image=image,
+        small_screen_geometry=small_screen_geometry or {},
+        small_screen_query=SMALL_SCREEN_QUERY
+    )
+
+
+# The home page of an atlas served next to the UBO atlas (see app/atlas.py):
+# its categories, each linking to its embed page, and the API
+ATLAS_TEMPLATE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <title>{{ title }}</title>
+    <style>
+        body { max-width: 800px; margin: 0 auto; padding: 8px; background-color: #FFF0E6; color: #002346; font-family: 'Mulish', sans-serif; }
+        .legend { font-size: 14px; }
+        .legend span { display: inline-block; width: 12px; height: 12px; margin: 0 4px 0 8px; vertical-align: middle; }
+        a { color: #002346; }
+    </style>
+</head>
+<body>
+    <h1>{{ title }}</h1>
+    {% for category in categories %}
+    <h2><a href="{{ category.url }}">{{ category.title }}</a></h2>
+    <p>{{ category.description }}</p>
+    <div class="legend">
+        {% for value, color in category.legend %}<span style="background-color: {{ color }}"></span>{{ value }}{% endfor %}
+    </div>
+    {% endfor %}
+    <p>Data: <a href="{{ api_url }}">{{ api_url }}</a></p>
+</body>
+</html>
+'''
+
+
+# Render the home page of an atlas; 'categories' is a list of dicts with the
+# title, description, legend and embed page URL of each category
+def render_atlas(title, categories, api_url):
+    return render_template_string(ATLAS_TEMPLATE, title=title, categories=categories, api_url=api_url)
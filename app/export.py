@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+
+from dash._utils import create_callback_id
+
+from app import app, dash_app, routes
+from app.cache import to_json
+
+
+# Components of the pages which need the server, e.g. the time slider (whose
+# snapshots are only served by the callbacks), and are left out of the export
+SERVER_COMPONENTS = {'snapshot-control'}
+
+# Directory the static site is exported to by `flask export`
+EXPORT_DIR = 'export'
+
+# Pages of the site and the files they are exported to
+PAGES = {
+    '/': 'index.html',
+    '/about': 'about/index.html',
+}
+
+
+def _content_hash(data):
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+# Export the response of the app for a URL, if there is one
+def _export_url(client, export_dir, url):
+    response = client.get(url)
+    if response.status_code == 200:
+        _write(export_dir, url, response.data)
+
+
+def _write(export_dir, url, data):
+    path = os.path.join(export_dir, url.split('?')[0].lstrip('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    with open(path, 'wb') as OUT:
+        OUT.write(data)
+    return path
+
+
+# Serialize a Dash component (tree) to plain dicts/lists
+def _plain(component):
+    return json.loads(to_json(component))
+
+
+# Layout of a page with the content display_page returns already filled in, so the
+# page doesn't need the routing callback. The home page always gets the data
+# of all categories as it is switched by the clientside engine.
+def page_layout(pathname):
+    layout = _plain(dash_app.layout)
+    content = [_plain(routes.page_content(pathname))]
+    if pathname != '/about' and app.config['UBO_CALLBACK_ENGINE'] != 'clientside':
+        content.append(_plain(routes.dcc.Store(id='category-data', data=routes.build_category_data())))
+    _update_components(layout, content)
+    return layout
+
+
+# Walk the layout to fill in the page content and to turn links into regular
+# links, as there is no routing callback to handle them in the browser. Links
+# to pages which are not exported (e.g., the filter page, which queries the
+# server) are removed from the navbar, as are the SERVER_COMPONENTS.
+def _update_components(component, content):
+    if isinstance(component, list):
+        component[:] = [
+            x for x in component if not (isinstance(x, dict) and x.get('props', {}).get('id') in SERVER_COMPONENTS)
+        ]
+        for child in component:
+            _update_components(child, content)
+        return
+    if not isinstance(component, dict) or 'props' not in component:
+        return
+
+    props = component['props']
+    if props.get('id') == 'page-content':
+        props['children'] = content
+    if component['type'] == 'NavLink':
+        props['external_link'] = True
+    if component['type'] == 'NavbarSimple':
+        props['brand_external_link'] = True
+        props['children'] = [x for x in props['children'] if x['props']['children']['props']['href'] in PAGES]
+    _update_components(props.get('children'), content)
+
+
+# Callbacks of a page; only the home page has one, which is run in the
+# browser
+def page_dependencies(pathname):
+    if pathname == '/about':
+        return []
+    return [{
+        'output': create_callback_id(routes.clientside_home_page_outputs),
+        'inputs': [x.to_dict() for x in routes.home_page_inputs],
+        'state': [{'id': 'category-data', 'property': 'data'}],
+        'clientside_function': {'namespace': 'ubo', 'function_name': 'update_home_page'},
+        'prevent_initial_call': False,
+    }]
+
+
+# Export the whole atlas as static files which nginx can serve without the
+# Flask app: the pages, the layout and callbacks of each page (in a directory
+# named after their hash, which the page's Dash config points to), the figures
+# of all categories, the Dash component bundles and the static files. Returns
+# the manifest describing the export.
+def export_site(export_dir=EXPORT_DIR):
+    if os.path.exists(export_dir):
+        shutil.rmtree(export_dir)
+    client = app.test_client()
+    manifest = {'version': routes.figure_cache.version, 'pages': {}, 'figures': {}}
+
+    for pathname, filename in PAGES.items():
+        layout = to_json(page_layout(pathname)).encode('utf-8')
+        dependencies = json.dumps(page_dependencies(pathname)).encode('utf-8')
+        prefix = f'/_pages/{_content_hash(layout + dependencies)}/'
+        _write(export_dir, prefix + '_dash-layout', layout)
+        _write(export_dir, prefix + '_dash-dependencies', dependencies)
+
+        html = client.get(pathname).get_data(as_text=True)
+        html = re.sub(
+            r'(<script id="_dash-config" type="application/json">)(.*?)(</script>)',
+            lambda x: x.group(1) + json.dumps(dict(json.loads(x.group(2)), requests_pathname_prefix=prefix)) + x.group(3),
+            html
+        )
+        _write(export_dir, filename, html)
+        manifest['pages'][pathname] = {'html': filename, 'prefix': prefix}
+
+        # Scripts, stylesheets and the favicon served by Dash
+        for url in re.findall(r'(?:src|href)="(/(?:_dash-component-suites|assets|_favicon)[^"]*)"', html):
+            _export_url(client, export_dir, url)
+
+    # Files which are loaded on demand by the components (e.g., the Plotly
+    # bundle of dcc.Graph), under their names without fingerprint; source maps
+    # are skipped
+    for package, paths in dash_app.registered_paths.items():
+        for path in paths:
+            if path.endswith('.map'):
+                continue
+            _export_url(client, export_dir, f'/_dash-component-suites/{package}/{path}')
+
+    for key in ['start'] + list(range(0, len(routes.ubo_info))):
+        figure = routes.figure_cache.get_json(key).encode('utf-8')
+        url = f'/figures/{key}.{_content_hash(figure)}.json'
+        _write(export_dir, url, figure)
+        manifest['figures'][str(key)] = url
+
+    # The service worker, which caches the bundles in the browser (see
+    # app/serviceworker.py); the exported responses carry no data version,
+    # so it leaves the rest to the browser's HTTP cache
+    _export_url(client, export_dir, '/sw.js')
+
+    shutil.copytree(os.path.join(app.root_path, 'static'), os.path.join(export_dir, 'static'))
+    _write(export_dir, '/figures/manifest.json', json.dumps(manifest, indent=2))
+    return manifest
+
+
+# Find the props of the component with an id in an exported layout
+def _find_props(component, id):
+    if isinstance(component, list):
+        for child in component:
+            props = _find_props(child, id)
+            if props is not None:
+                return props
+        return None
+    if not isinstance(component, dict) or 'props' not in component:
+        return None
+    if component['props'].get('id') == id:
+        return component['props']
+    return _find_props(component['props'].get('children'), id)
+
+
+# The data of all categories in the layout of the exported home page, from
+# which the clientside update_home_page builds the figures it shows (see
+# tests/test_export.py, which checks them against the data)
+def exported_category_data(manifest, export_dir=EXPORT_DIR):
+    prefix = manifest['pages']['/']['prefix']
+    with open(os.path.join(export_dir, prefix.lstrip('/'), '_dash-layout')) as IN:
+        return _find_props(json.load(IN), 'category-data')['data']
@@ -0,0 +1,70 @@
+# Turn a list of colors into a colorscale with the colors spaced evenly, the
+# same as Plotly does (a single color is used for the whole scale)
+def evenly_spaced(colors):
+    if len(colors) == 1:
+        colors = colors * 2
+    return [[i / (len(colors) - 1), color] for i, color in enumerate(colors)]
+
+
+# The figure of the map of a category of a dataset (see app/dataset.py), as
+# plain dicts. 'geojson' is the geometry or its URL, 'colors' maps the status
+# codes to colors and the scope (one of Plotly's geo scopes) and lat/lon
+# ranges are the part of the world shown.
+def category_figure(dataset, category_index, geojson, colors, lat_range, lon_range, scope='europe'):
+    # Results value for each country, e.g. [1, 1, 4, 3, ...]
+    category = dataset.categories[category_index]
+    results = category['status']
+    return {
+        'data': [
+            {
+                'type': 'choropleth',
+                # This specifies that we provide our own geojson
+                'locationmode': 'geojson-id',
+                # Provide our own custom geojson (or the URL to it)
+                'geojson': geojson,
+                # Specify the key in the geojson containing the country
+                # ISO 3166-1 alpha-3 code
+                'featureidkey': 'properties.iso_a3',
+                # ISO 3166-1 alpha-3 code of the countries we want to show,
+                # e.g., ['AUT', 'BEL', 'BGR', ...]
+                'locations': dataset.codes,
+                'z': results,
+                'showscale': False,
+                # Only retrieve the colors that are actually used in a map,
+                # otherwise gradients of the colors might be used
+                'colorscale': evenly_spaced([colors[x] for x in list(set(sorted(results)))]),
+                # Provide text for the tooltips
+                'text': [
+                    '<b>{0}</b>: {1}<br>{2}'.format(
+                            country,
+                            # Result
+                            value,
+                            # Retrieve any extra tooltip info
+                            tooltip
+                        ) for country, value, tooltip in zip(dataset.names, category['values'], category['tooltips'])
+                ],
+                'hoverinfo': "text",
+            }
+        ],
+        'layout': {
+            'geo': {
+                'scope': scope,
+                'domain': {
+                    'x': [0, 1],
+                    'y': [0, 1]
+                },
+                'lataxis': {'range': lat_range},
+                'lonaxis': {'range': lon_range},
+                'showcoastlines': False,
+                'resolution': 50,
+                'showframe': False,
+                'projection': {'type': 'mercator'},
+                'showland': False,
+                'showocean': True,
+                'oceancolor': '#FFF0E6',
+            },
+            'showlegend': False,
+            'margin': {'l': 0, 'r': 0, 't': 0, 'b': 0},
+            'font': {'family': "'Montserrat', sans-serif"},
+        }
+    }
@@ -0,0 +1,14 @@
+import os
+
+
+# Write a file (from bytes or a string) through a temporary file which is then
+# moved in place, so other processes, e.g. the other uWSGI workers, never read
+# a partially written file; its directory is created if it doesn't exist yet
+def atomic_write(path, data):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as OUT:
+        OUT.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,377 @@
+import hashlib
+import json
+import math
+import os
+
+from app.files import atomic_write
+
+
+# Directory and URL of the static geometry files, served by nginx
+GEOMETRY_DIR = 'app/static/geo'
+GEOMETRY_URL = '/static/geo/'
+
+
+# Write the geometry to a static file whose name contains a hash of its
+# content and return the URL of that file. As the name changes whenever the
+# geometry changes, browsers and nginx can cache the file forever. The
+# geometry may also be given as the bytes of a GeoJSON file, which are then
+# published as is without parsing them.
+def publish_geojson(geojson, name='countries'):
+    if isinstance(geojson, bytes):
+        serialized = geojson
+    else:
+        serialized = json.dumps(geojson, separators=(',', ':')).encode('utf-8')
+    filename = f'{name}.{hashlib.sha1(serialized).hexdigest()[:12]}.json'
+    path = os.path.join(GEOMETRY_DIR, filename)
+
+    # Every uWSGI worker runs this, so write it atomically
+    if not os.path.exists(path):
+        atomic_write(path, serialized)
+
+    return GEOMETRY_URL + filename
+
+
+# Levels of detail of the optimized geometry: the number of decimals the
+# coordinates are quantized to and the tolerance (in degrees) used to simplify
+# the borders. At the zoom level of the map 3 decimals (~100 m) are more than
+# a pixel can show on a desktop screen, 2 decimals (~1 km) on a phone.
+LEVELS_OF_DETAIL = {
+    'desktop': {'digits': 3, 'tolerance': 0.005},
+    'mobile': {'digits': 2, 'tolerance': 0.03},
+}
+
+# Level of detail which the pages load on small screens, and the media query
+# of those screens (below the 'md' breakpoint of Bootstrap, where the map
+# takes the whole width of the page)
+SMALL_SCREEN_LOD = 'mobile'
+SMALL_SCREEN_QUERY = '(max-width: 767.98px)'
+
+# Margin in degrees kept around the viewport when clipping, so countries just
+# outside the lat/lon ranges (e.g., Malta and Cyprus) and the edges of the map
+# stay intact if the map is shown with a different aspect ratio
+CLIP_MARGIN = 5
+
+# Directory containing the output of the geometry build
+BUILD_DIR = 'data/build'
+
+
+# Return the path of the optimized GeoJSON of a level of detail
+def optimized_geojson_path(lod):
+    return os.path.join(BUILD_DIR, f'countries.{lod}.geo.json')
+
+
+# Size of the compact JSON serialization of an object in bytes
+def json_size(obj):
+    return len(json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+
+
+# Return the polygons of a geometry as a list, regardless of whether it is a
+# Polygon or a MultiPolygon
+def _polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+# Return a feature with the given polygons as (Multi)Polygon geometry
+def _feature(feature, polygons):
+    if len(polygons) == 1:
+        geometry = {'type': 'Polygon', 'coordinates': polygons[0]}
+    else:
+        geometry = {'type': 'MultiPolygon', 'coordinates': polygons}
+    return {'type': 'Feature', 'properties': feature['properties'], 'geometry': geometry}
+
+
+# Apply a function to every ring of every feature, dropping rings for which it
+# returns None, polygons without exterior ring and features without polygons
+def _map_rings(geojson, function):
+    features = []
+    for feature in geojson['features']:
+        polygons = []
+        for polygon in _polygons(feature['geometry']):
+            rings = [function(ring) for ring in polygon]
+            if rings[0] is None:
+                continue
+            polygons.append([ring for ring in rings if ring is not None])
+        if polygons:
+            features.append(_feature(feature, polygons))
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+# Only keep the features of the given countries and of their properties only
+# the key used to match them to the data
+def prune(geojson, codes, key='iso_a3'):
+    codes = set(codes)
+    return {
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'properties': {key: feature['properties'][key]},
+                'geometry': feature['geometry'],
+            } for feature in geojson['features'] if feature['properties'][key] in codes
+        ]
+    }
+
+
+# Clip a ring to a rectangle (Sutherland-Hodgman); edges outside of the
+# rectangle are replaced by edges along its border
+def _clip_ring(ring, bounds):
+    min_lon, min_lat, max_lon, max_lat = bounds
+    edges = [
+        (lambda p: p[0] >= min_lon, 0, min_lon),
+        (lambda p: p[0] <= max_lon, 0, max_lon),
+        (lambda p: p[1] >= min_lat, 1, min_lat),
+        (lambda p: p[1] <= max_lat, 1, max_lat),
+    ]
+
+    points = ring[:-1]
+    for inside, axis, value in edges:
+        if not points:
+            break
+        clipped = []
+        previous = points[-1]
+        for point in points:
+            if inside(point):
+                if not inside(previous):
+                    clipped.append(_intersection(previous, point, axis, value))
+                clipped.append(point)
+            elif inside(previous):
+                clipped.append(_intersection(previous, point, axis, value))
+            previous = point
+        points = clipped
+
+    if len(points) < 3:
+        return None
+    return points + [points[0]]
+
+
+# Point where the segment a-b crosses the line where coordinate 'axis' equals
+# 'value'
+def _intersection(a, b, axis, value):
+    t = (value - a[axis]) / (b[axis] - a[axis])
+    point = [a[0] + t * (b[0] - a[0]), a[1] + t * (b[1] - a[1])]
+    point[axis] = value
+    return point
+
+
+# Clip all features to a lon/lat window, given as (min_lon, min_lat, max_lon,
+# max_lat)
+def clip(geojson, bounds):
+    return _map_rings(geojson, lambda ring: _clip_ring(ring, bounds))
+
+
+# Round a ring to the given number of decimals, dropping points that end up
+# on top of the previous point and rings that become degenerate
+def _quantize_ring(ring, digits):
+    points = []
+    for lon, lat in ring:
+        point = [round(lon, digits), round(lat, digits)]
+        if not points or point != points[-1]:
+            points.append(point)
+    if len(points) < 4:
+        return None
+    return points
+
+
+def quantize(geojson, digits):
+    return _map_rings(geojson, lambda ring: _quantize_ring(ring, digits))
+
+
+# Douglas-Peucker simplification of a line given as integer points; the end
+# points are always kept
+def _simplify_line(points, tolerance):
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = math.hypot(dx, dy)
+        max_distance, index = 0, None
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if length:
+                distance = abs(dy * x - dx * y + x2 * y1 - y2 * x1) / length
+            else:
+                distance = math.hypot(x - x1, y - y1)
+            if distance > max_distance:
+                max_distance, index = distance, i
+        if index is not None and max_distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+# Rotate a closed ring without junctions so it starts at its smallest point,
+# which makes identical rings (e.g., an enclave and the hole around it)
+# compare equal
+def _canonical_ring(points):
+    start = points.index(min(points))
+    return points[start:] + points[:start] + [points[start]]
+
+
+# Build a TopoJSON topology from a (quantized) GeoJSON. Borders shared by two
+# countries are stored only once as an arc which both countries refer to; arc
+# coordinates are integers, delta encoded relative to the previous point.
+def to_topology(geojson, digits, tolerance=0):
+    factor = 10 ** digits
+    features = [
+        (
+            feature['properties'],
+            [
+                [[(round(lon * factor), round(lat * factor)) for lon, lat in ring[:-1]] for ring in polygon]
+                for polygon in _polygons(feature['geometry'])
+            ]
+        ) for feature in geojson['features']
+    ]
+    rings = [ring for _, polygons in features for polygon in polygons for ring in polygon]
+
+    # A junction is a point where a border splits, i.e. a point which is
+    # visited by rings coming from or going to different neighbours
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        for i, point in enumerate(ring):
+            pair = frozenset((ring[i - 1], ring[(i + 1) % len(ring)]))
+            if neighbours.setdefault(point, pair) != pair:
+                junctions.add(point)
+
+    arcs = []
+    arc_index = {}
+
+    # Return the index of an arc, or its one's complement if the arc is
+    # stored in the opposite direction
+    def index_arc(arc):
+        arc = tuple(arc)
+        if arc in arc_index:
+            return arc_index[arc]
+        if arc[::-1] in arc_index:
+            return ~arc_index[arc[::-1]]
+        arc_index[arc] = len(arcs)
+        arcs.append(arc)
+        return arc_index[arc]
+
+    def ring_arcs(ring):
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if not cuts:
+            return [index_arc(_canonical_ring(ring))]
+        ring = ring[cuts[0]:] + ring[:cuts[0]] + [ring[cuts[0]]]
+        cuts = [i - cuts[0] for i in cuts] + [len(ring) - 1]
+        return [index_arc(ring[start:end + 1]) for start, end in zip(cuts, cuts[1:])]
+
+    geometries = []
+    for properties, polygons in features:
+        polygon_arcs = [[ring_arcs(ring) for ring in polygon] for polygon in polygons]
+        if len(polygon_arcs) == 1:
+            geometries.append({'type': 'Polygon', 'properties': properties, 'arcs': polygon_arcs[0]})
+        else:
+            geometries.append({'type': 'MultiPolygon', 'properties': properties, 'arcs': polygon_arcs})
+
+    # Simplify every arc on its own; as the end points of arcs are kept,
+    # countries sharing a border still share exactly the same border
+    if tolerance:
+        simplified = []
+        for arc in arcs:
+            line = _simplify_line(list(arc), tolerance * factor)
+            # Keep closed arcs (islands) from collapsing
+            if arc[0] == arc[-1] and len(line) < 4:
+                line = list(arc)
+            simplified.append(line)
+        arcs = simplified
+
+    # Store the arcs relative to the bottom left corner and delta encoded
+    min_x = min(x for arc in arcs for x, _ in arc)
+    min_y = min(y for arc in arcs for _, y in arc)
+    encoded = []
+    for arc in arcs:
+        previous = (min_x, min_y)
+        deltas = []
+        for x, y in arc:
+            deltas.append([x - previous[0], y - previous[1]])
+            previous = (x, y)
+        encoded.append(deltas)
+
+    return {
+        'type': 'Topology',
+        'transform': {
+            'scale': [1 / factor, 1 / factor],
+            'translate': [min_x / factor, min_y / factor],
+        },
+        'objects': {'countries': {'type': 'GeometryCollection', 'geometries': geometries}},
+        'arcs': encoded,
+    }
+
+
+# Convert a topology created by to_topology back to GeoJSON, which is what
+# Plotly needs
+def from_topology(topology, digits):
+    scale_x, scale_y = topology['transform']['scale']
+    translate_x, translate_y = topology['transform']['translate']
+    arcs = []
+    for deltas in topology['arcs']:
+        x = y = 0
+        arc = []
+        for dx, dy in deltas:
+            x += dx
+            y += dy
+            arc.append([round(x * scale_x + translate_x, digits), round(y * scale_y + translate_y, digits)])
+        arcs.append(arc)
+
+    def ring(indexes):
+        points = []
+        for index in indexes:
+            arc = arcs[index] if index >= 0 else arcs[~index][::-1]
+            points.extend(arc if not points else arc[1:])
+        return points if len(points) >= 4 else None
+
+    features = []
+    for geometry in topology['objects']['countries']['geometries']:
+        polygons = geometry['arcs'] if geometry['type'] == 'MultiPolygon' else [geometry['arcs']]
+        rings = [[ring(indexes) for indexes in polygon] for polygon in polygons]
+        rings = [[r for r in polygon if r is not None] for polygon in rings if polygon[0] is not None]
+        if rings:
+            features.append(_feature(geometry, rings))
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+# Turn the source GeoJSON into optimized GeoJSON (and optionally TopoJSON) files
+# for every level of detail. Returns a report listing the size of the geometry
+# after each stage as (stage, size in bytes) tuples.
+def build_geometry(source, codes, bounds, topojson=False, build_dir=BUILD_DIR):
+    min_lon, min_lat, max_lon, max_lat = bounds
+    bounds = (min_lon - CLIP_MARGIN, min_lat - CLIP_MARGIN, max_lon + CLIP_MARGIN, max_lat + CLIP_MARGIN)
+
+    with open(source) as IN:
+        geojson = json.load(IN)
+    report = [('source', json_size(geojson))]
+
+    geojson = prune(geojson, codes)
+    report.append(('prune', json_size(geojson)))
+
+    geojson = clip(geojson, bounds)
+    report.append(('clip', json_size(geojson)))
+
+    os.makedirs(build_dir, exist_ok=True)
+    for lod, settings in LEVELS_OF_DETAIL.items():
+        quantized = quantize(geojson, settings['digits'])
+        report.append((f'{lod}: quantize', json_size(quantized)))
+
+        topology = to_topology(quantized, settings['digits'], settings['tolerance'])
+        optimized = from_topology(topology, settings['digits'])
+        report.append((f'{lod}: simplify', json_size(optimized)))
+        _write_json(optimized, os.path.join(build_dir, f'countries.{lod}.geo.json'))
+
+        if topojson:
+            report.append((f'{lod}: topojson', json_size(topology)))
+            _write_json(topology, os.path.join(build_dir, f'countries.{lod}.topo.json'))
+
+    return report
+
+
+def _write_json(obj, path):
+    atomic_write(path, json.dumps(obj, separators=(',', ':')))
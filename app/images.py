@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+
+from app.files import atomic_write
+
+
+# Directory and URL of the prerendered images of the maps, served by nginx
+IMAGE_DIR = 'app/static/maps'
+IMAGE_URL = '/static/maps/'
+
+# Formats each map is rendered in; PNG is used for og:image (which not all
+# link unfurlers support in other formats), WebP for the placeholders of
+# browsers which support it and SVG for print
+IMAGE_FORMATS = ('png', 'webp', 'svg')
+
+# Size of the images, the size recommended for og:image
+IMAGE_WIDTH = 1200
+IMAGE_HEIGHT = 630
+
+# Lists the images of each map with the hash of the figure they were rendered
+# from; kept out of the static directory as it changes with every rendering
+MANIFEST_FILE = 'data/build/maps.json'
+
+
+# Hash of a figure serialized to JSON, to tell whether an image still shows
+# the current figure
+def figure_hash(figure_json):
+    return hashlib.sha1(figure_json.encode('utf-8')).hexdigest()
+
+
+def load_manifest(path=MANIFEST_FILE):
+    try:
+        with open(path) as IN:
+            return json.load(IN)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+# Write an image to a static file whose name contains a hash of its content
+# and return the URL of that file, so browsers, nginx and link unfurlers can
+# cache it forever (see publish_geojson in app/geometry.py)
+def publish_image(image, name, format):
+    filename = f'{name}.{hashlib.sha1(image).hexdigest()[:12]}.{format}'
+    path = os.path.join(IMAGE_DIR, filename)
+    if not os.path.exists(path):
+        atomic_write(path, image)
+    return IMAGE_URL + filename
+
+
+def _image_exists(url):
+    return os.path.exists(os.path.join(IMAGE_DIR, url[len(IMAGE_URL):]))
+
+
+# Render the images of the maps with kaleido (an optional dependency, which
+# runs a headless browser and so takes about a second per image). 'figures'
+# maps the name of each map to its figure serialized to JSON; maps whose
+# figure didn't change since the last rendering keep their images. The
+# geometry is put into figures which only refer to its URL, as the renderer
+# doesn't load it. Writes the manifest and returns the names of the maps
+# which were rendered.
+def render_images(figures, geojson_file, manifest_file=MANIFEST_FILE):
+    import plotly.io as pio
+
+    manifest = load_manifest(manifest_file)
+    geojson = None
+    rendered = []
+    for name, figure_json in figures.items():
+        digest = figure_hash(figure_json)
+        entry = manifest.get(name)
+        if (entry and entry['figure'] == digest and (entry['width'], entry['height']) == (IMAGE_WIDTH, IMAGE_HEIGHT)
+                and all(format in entry and _image_exists(entry[format]) for format in IMAGE_FORMATS)):
+            continue
+
+        figure = json.loads(figure_json)
+        for trace in figure['data']:
+            if isinstance(trace.get('geojson'), str):
+                if geojson is None:
+                    with open(geojson_file) as IN:
+                        geojson = json.load(IN)
+                trace['geojson'] = geojson
+
+        entry = {'figure': digest, 'width': IMAGE_WIDTH, 'height': IMAGE_HEIGHT}
+        for format in IMAGE_FORMATS:
+            image = pio.to_image(figure, format=format, width=IMAGE_WIDTH, height=IMAGE_HEIGHT, validate=False)
+            entry[format] = publish_image(image, name, format)
+        manifest[name] = entry
+        rendered.append(name)
+
+    manifest = {name: entry for name, entry in manifest.items() if name in figures}
+    atomic_write(manifest_file, json.dumps(manifest, indent=2, sort_keys=True))
+    return rendered
+
+
+# The images of the maps which show the current figures, i.e. the entries of
+# the manifest whose figure hash matches; images of an older data version
+# are never shown, the pages then fall back to the generic og:image and show
+# no placeholder until the images have been rendered again
+class MapImages(object):
+    def __init__(self, manifest, figure_hashes):
+        self.images = {
+            name: entry for name, entry in manifest.items() if figure_hashes.get(name) == entry.get('figure')
+        }
+        # Changes whenever an image is added, removed or replaced, so
+        # responses referring to the images can be cached with it
+        self.version = hashlib.sha1(json.dumps(self.images, sort_keys=True).encode('utf-8')).hexdigest()
+
+    # URL of the image of a map in a format, or None if there is none
+    def url(self, name, format='png'):
+        return self.images.get(name, {}).get(format)
@@ -0,0 +1,280 @@
+import glob
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, request
+
+from app.files import atomic_write
+
+
+# Buckets of the histograms of durations (in seconds) and sizes (in bytes)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+# Format labels as in the Prometheus text format, e.g. '{endpoint="static"}'
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs
+    ]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+# Key of the values of a metric with specific labels; label values are
+# always strings
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Counters, gauges and histograms of one process, which every worker writes
+# to a file of its own in a shared directory every few seconds; the /metrics
+# endpoint adds up the files of all workers (the worker answering the request
+# uses its current values instead of its file). Recording a value only takes
+# a lock and a dict update, so the metrics can always be on.
+#
+# Counters and histograms are summed over the workers (including workers
+# which were restarted since, so they never decrease), gauges are the
+# maximum over the workers which are still running.
+class Metrics(object):
+    def __init__(self, directory=None, interval=5):
+        self.directory = directory
+        self.interval = interval
+        # Type, help text and (for histograms) buckets of each metric
+        self.definitions = {}
+        # Values per (name, labels), labels being a tuple of (key, value)
+        # pairs (see _key)
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+        # Functions returning extra counters, e.g. of caches which already
+        # count their hits and misses, as [(name, labels dict, value)]
+        self.collectors = []
+        self.path = None
+        self.lock = threading.Lock()
+
+    def counter(self, name, help):
+        self.definitions[name] = ('counter', help, None)
+
+    def gauge(self, name, help):
+        self.definitions[name] = ('gauge', help, None)
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS):
+        self.definitions[name] = ('histogram', help, buckets)
+
+    def collect(self, function):
+        self.collectors.append(function)
+        return function
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def set(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        buckets = self.definitions[name][2]
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Count per bucket (the last one being +Inf) and the sum
+                histogram = self.histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(buckets)] += 1
+            histogram[-1] += value
+
+    # Forget everything recorded so far, e.g. in a worker forked from a
+    # process which already recorded values (the uWSGI master when preloading)
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    # All values of this process as plain JSON-serializable lists
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            snapshot = {
+                'pid': os.getpid(),
+                'gauges': [[name, list(labels), value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, list(labels), list(values)] for (name, labels), values in self.histograms.items()],
+            }
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                counters[_key(name, labels)] = value
+        snapshot['counters'] = [[name, list(labels), value] for (name, labels), value in counters.items()]
+        return snapshot
+
+    # Write the values of this process to its file, atomically so the other
+    # workers never read a partially written file
+    def write(self):
+        atomic_write(self.path, json.dumps(self.snapshot()))
+
+    # Keep writing, also if a write failed (e.g., as the directory was
+    # removed, which is then created again)
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    # Start writing the values of this process to the directory, to be called
+    # in every worker after the fork; 'since' is the time the server started,
+    # before which the files of processes which are no longer running belong
+    # to a previous run and are removed (see remove_stale)
+    def start(self, since=None):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if since is not None:
+            self.remove_stale(since)
+        self.path = os.path.join(self.directory, f'{os.getpid()}-{time.time():.0f}.json')
+        self.write()
+        thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+        thread.start()
+
+    # Remove the files of previous runs, to be called by the process the
+    # workers are forked from, before the fork
+    def clear_directory(self):
+        if self.directory:
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                os.remove(path)
+
+    # Remove the files of processes which started before 'since' and are no
+    # longer running, e.g. when the workers aren't forked from a process which
+    # cleared the directory (without preloading, or with --lazy-apps); files of
+    # workers which stopped since are kept, so the counters never decrease
+    def remove_stale(self, since):
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                pid, started = os.path.basename(path)[:-len('.json')].split('-', 1)
+                pid, started = int(pid), float(started)
+            except ValueError:
+                continue
+            if started < since and not _is_running(pid):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # Removed by another worker starting at the same time
+                    pass
+
+    # Values of this process and, if it writes them to the directory, of all
+    # processes in the directory
+    def _snapshots(self):
+        snapshots = [self.snapshot()]
+        if self.path:
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                if path == self.path:
+                    continue
+                try:
+                    with open(path) as IN:
+                        snapshots.append(json.load(IN))
+                except (OSError, ValueError):
+                    continue
+        return snapshots
+
+    # All metrics of all workers in the Prometheus text format
+    def render(self):
+        counters = defaultdict(float)
+        gauges = {}
+        histograms = {}
+        for snapshot in self._snapshots():
+            alive = snapshot['pid'] == os.getpid() or _is_running(snapshot['pid'])
+            for name, labels, value in snapshot['counters']:
+                counters[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(map(tuple, labels)))
+                if alive:
+                    gauges[key] = max(value, gauges.get(key, value))
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                if key in histograms:
+                    histograms[key] = [x + y for x, y in zip(histograms[key], values)]
+                else:
+                    histograms[key] = values
+
+        lines = []
+        for name, (kind, help, buckets) in sorted(self.definitions.items()):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+            elif kind == 'gauge':
+                for (metric, labels), value in sorted(gauges.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+            else:
+                for (metric, labels), values in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(buckets) + ['+Inf'], values):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(values[-1])}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    # Time every request and measure the size of every response; 'labels' is
+    # a function returning extra labels for the current request (e.g., the
+    # Dash callback it runs). The hooks are put first in line, so the timer
+    # starts before any other hook (which might answer the request itself)
+    # and, as Flask runs the after request hooks in reverse, the size is
+    # that of the final, e.g. compressed, response.
+    def init_app(self, app, labels=None):
+        self.labels = labels
+
+        def start_timer():
+            g.metrics_start = time.perf_counter()
+
+        def record_request(response):
+            start = g.get('metrics_start')
+            if start is None:
+                return response
+            labels = {'endpoint': request.endpoint or 'none'}
+            if self.labels:
+                labels.update(self.labels())
+            self.observe('ubo_request_duration_seconds', time.perf_counter() - start, **labels)
+            if not response.direct_passthrough:
+                self.observe('ubo_response_bytes', response.calculate_content_length() or 0, **labels)
+            self.inc('ubo_responses_total', status=response.status_code, **labels)
+            return response
+
+        app.before_request_funcs.setdefault(None, []).insert(0, start_timer)
+        app.after_request_funcs.setdefault(None, []).insert(0, record_request)
+
+        self.histogram('ubo_request_duration_seconds', 'Time spent handling requests.')
+        self.histogram('ubo_response_bytes', 'Size of the response bodies as sent, i.e. compressed if they were.', SIZE_BUCKETS)
+        self.counter('ubo_responses_total', 'Responses per status code.')
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
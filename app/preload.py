@@ -0,0 +1,66 @@
+import gc
+import time
+
+from flask import jsonify
+
+from app import app, routes, uwsgi
+from app.client import dash_requests, dataset_requests, embed_requests
+from app.responses import ENCODINGS
+
+
+routes.metrics.gauge('ubo_warm_up_seconds', 'Time the warm-up of the workers took.')
+
+# Time the warm-up of this process took, None until it is done
+warm_up_seconds = None
+
+
+# Make all requests of the pages, the embed pages and the whole dataset once,
+# so everything Flask and Dash only set up on the first requests (e.g., the
+# URL map and the index page) and the responses kept by the response cache
+# already exist. Cached responses are only compressed in an encoding once a
+# client asks for it (see CachedResponse in app/responses.py), so the embed
+# pages and the dataset, the largest bodies, are requested in every encoding,
+# and browsers get them compressed at the first request. These requests are
+# no real traffic, so the metrics and the counters of the caches start from
+# zero afterwards.
+def warm_up():
+    global warm_up_seconds
+    start = time.perf_counter()
+    client = app.test_client()
+    client.get('/')
+    requests = [(x, ['identity']) for x in dash_requests()]
+    requests += [(x, ENCODINGS) for x in embed_requests() + dataset_requests()]
+    for (name, method, path, body), encodings in requests:
+        for encoding in encodings:
+            response = client.open(path, method=method, json=body, headers={'Accept-Encoding': encoding})
+            if response.status_code != 200:
+                app.logger.warning(f'Warming up {name} failed with status {response.status_code}')
+    routes.metrics.reset()
+    routes.reset_cache_stats()
+
+    warm_up_seconds = time.perf_counter() - start
+    routes.metrics.set('ubo_warm_up_seconds', warm_up_seconds)
+    app.logger.info(f'Warmed up in {warm_up_seconds:.3f}s')
+
+
+# Prepare the app in the process the workers are forked from (the uWSGI
+# master), so the workers share the data, the figures, the warmed up caches
+# and all Dash objects with it instead of each building their own copy. The
+# garbage collector writes to every object it examines, which would make each
+# worker copy the memory pages holding them, so all objects existing at this
+# point are frozen: moved out of the reach of the garbage collector for good
+# (they live as long as the workers anyway). The metrics files of the
+# previous workers are removed, as the new workers start counting again.
+def preload():
+    warm_up()
+    routes.metrics.clear_directory()
+    gc.freeze()
+
+
+# Whether this worker has been warmed up, for health checks of load balancers
+# and deploys; the development server isn't warmed up and is always ready
+@app.route('/ready')
+def ready():
+    if uwsgi and warm_up_seconds is None:
+        return jsonify(ready=False), 503
+    return jsonify(ready=True, warm_up_seconds=warm_up_seconds)
@@ -0,0 +1,99 @@
+import re
+
+
+# Identifier of a category or result in queries, e.g. 'who-has-access' for
+# 'Who has access?' and 'n-a' for 'N/A'
+def slugify(text):
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')
+
+
+class QueryError(ValueError):
+    pass
+
+
+# Number of countries in a bitset
+def count(bits):
+    return bin(bits).count('1')
+
+
+# Positions in the country index of the countries in a bitset
+def members(bits):
+    positions = []
+    while bits:
+        lowest = bits & -bits
+        positions.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return positions
+
+
+# The results of a dataset as a country x category matrix of status codes
+# with, per category, a bitset of the countries for each result and for each
+# status code. A bitset is an int in which bit i is set if the country at
+# position i in the country index has that result, so a query like 'public
+# access AND no paywall' is answered by combining a few ints with & and |,
+# however many countries and categories there are.
+class StatusIndex(object):
+    def __init__(self, dataset, categories):
+        self.dataset = dataset
+        self.version = dataset.version
+        self.size = len(dataset.codes)
+        self.all = (1 << self.size) - 1
+        # Status codes row by row, one row of countries per category
+        self.matrix = bytes(status for category in dataset.categories for status in category['status'])
+        self.slugs = [slugify(x['title']) for x in categories]
+        self.positions = {slug: i for i, slug in enumerate(self.slugs)}
+        # Per category a dict of the slugs of its results, in the order of
+        # the category definition, to the result and its bitset
+        self.results = []
+        # Per category a dict of the status codes to their bitsets
+        self.statuses = []
+        for category, compiled in zip(categories, dataset.categories):
+            results = {slugify(value): [value, 0] for value in category['status']}
+            statuses = {status: 0 for status in category['status'].values()}
+            for i, (value, status) in enumerate(zip(compiled['values'], compiled['status'])):
+                results[slugify(value)][1] |= 1 << i
+                statuses[status] |= 1 << i
+            self.results.append(results)
+            self.statuses.append(statuses)
+
+    # Status code of a country in a category
+    def status(self, category, country):
+        return self.matrix[category * self.size + country]
+
+    # Turn the arguments of a request (a dict of category slugs to lists of
+    # result slugs, which may also be comma separated) into a query: a tuple
+    # of (category, result slugs) pairs ordered by category, so equal queries
+    # are equal however they were written
+    def parse(self, args):
+        query = {}
+        for slug, values in args.items():
+            if slug not in self.positions:
+                raise QueryError(f"Unknown category '{slug}', expected one of {self.slugs}")
+            category = self.positions[slug]
+            results = query.setdefault(category, set())
+            for value in values:
+                for result in filter(None, value.split(',')):
+                    if result not in self.results[category]:
+                        raise QueryError(
+                            f"Unknown result '{result}' for '{slug}', expected one of {list(self.results[category])}"
+                        )
+                    results.add(result)
+        return tuple((category, tuple(sorted(results))) for category, results in sorted(query.items()) if results)
+
+    # Bitset of the countries matching a query: any of the given results of a
+    # category and all of the given categories
+    def match(self, query):
+        bits = self.all
+        for category, results in query:
+            any_of = 0
+            for result in results:
+                any_of |= self.results[category][result][1]
+            bits &= any_of
+        return bits
+
+    # Number of countries in a bitset per status code, per category
+    def status_counts(self, bits):
+        return [
+            {status: count(bits & status_bits) for status, status_bits in statuses.items()}
+            for statuses in self.statuses
+        ]
@@ -0,0 +1,209 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from flask import g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Preferred order of the encodings of precompressed responses
+ENCODINGS = ['br', 'gzip', 'identity'] if brotli else ['gzip', 'identity']
+
+
+# Compression levels per encoding: the best ones for responses built ahead
+# of time (like the exports of the dataset), and cheaper ones for responses
+# compressed while a client waits, which are still close in size for the
+# small bodies of the callbacks (e.g. brotli 5 takes under a millisecond where
+# 11 takes several, for 10% more bytes)
+LEVELS = {
+    'best': {'gzip': 9, 'br': 11},
+    'fast': {'gzip': 6, 'br': 5},
+}
+
+# Properties of the inputs of Dash callbacks which grow with every click of
+# a button; the callbacks of the atlas only look at which button was clicked
+# (changedPropIds), so their values are left out of the keys of the cache
+CLICK_PROPS = ('n_clicks', 'n_clicks_timestamp')
+
+
+# Compress a body in one of the supported encodings
+def compress_body(body, encoding, level='best'):
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=LEVELS[level]['gzip'], mtime=0)
+    if encoding == 'br':
+        return brotli.compress(body, quality=LEVELS[level]['br'])
+    return body
+
+
+# Strong ETag of a body in a specific encoding; all encodings share the hash
+# of the uncompressed body so a 304 can be given regardless of the encoding
+def etag_for(digest, encoding):
+    if encoding == 'identity':
+        return digest
+    return f'{digest}-{encoding}'
+
+
+# Pick the best encoding accepted by the client
+def choose_encoding(accept_encodings):
+    for encoding in ENCODINGS:
+        if encoding == 'identity' or accept_encodings[encoding]:
+            return encoding
+    return 'identity'
+
+
+# Leave the values of the given properties out of the inputs and state of the
+# request body of a Dash callback (with wildcards, an input can also be a list
+# of inputs), so requests which only differ in those share a cache entry
+def drop_values(body, props):
+    def drop(item):
+        if isinstance(item, list):
+            return [drop(x) for x in item]
+        if isinstance(item, dict) and item.get('property') in props:
+            return {key: value for key, value in item.items() if key != 'value'}
+        return item
+
+    return dict(body, **{key: drop(body[key]) for key in ('inputs', 'state') if isinstance(body.get(key), list)})
+
+
+# A response stored in every encoding a client asked for, each compressed
+# when it is first needed
+class CachedResponse(object):
+    def __init__(self, body, mimetype, cache_control, level='best'):
+        self.digest = hashlib.sha1(body).hexdigest()
+        self.bodies = {'identity': body}
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self.level = level
+
+    # Compressing an encoding twice at the same time only wastes some time,
+    # so no lock is needed
+    def body(self, encoding):
+        body = self.bodies.get(encoding)
+        if body is None:
+            body = self.bodies[encoding] = compress_body(self.bodies['identity'], encoding, self.level)
+        return body
+
+    @property
+    def size(self):
+        return sum(len(x) for x in list(self.bodies.values()))
+
+    # Build the response for the current request, which is a 304 if the client
+    # already has this response
+    def make_response(self, response_class):
+        if any(tag.split('-')[0] == self.digest for tag in request.if_none_match.as_set()):
+            response = response_class(status=304)
+            encoding = 'identity'
+        else:
+            encoding = choose_encoding(request.accept_encodings)
+            response = response_class(self.body(encoding), mimetype=self.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag_for(self.digest, encoding))
+        response.headers['Cache-Control'] = self.cache_control
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+# Keeps the (compressed) bodies of deterministic responses, i.e. responses
+# which only depend on the request and the data version, and serves them
+# without calling the view again. Entries are kept per data version in a
+# bounded LRU. The values of 'ignored_props' (e.g. CLICK_PROPS) are left out
+# of the keys of callback requests, and the responses are compressed at the
+# 'fast' levels, as a miss is compressed while the client waits.
+class ResponseCache(object):
+    def __init__(self, get_version, paths, max_entries=1024, cache_control='no-cache', ignored_props=()):
+        # Function returning the current data version
+        self.get_version = get_version
+        self.paths = set(paths)
+        self.ignored_props = set(ignored_props)
+        self.max_entries = max_entries
+        self.cache_control = cache_control
+        self.version = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Attribute of flask.g holding the key and data version of the current
+        # request, if this cache handles it; every instance (e.g. one per
+        # atlas) has its own, as all of them see every request
+        self.g_name = f'response_cache_{id(self)}'
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    # Key of the current request; JSON bodies are normalized first, so
+    # requests with the same content share an entry however their client
+    # formatted them (e.g., browsers and app/client.py), and so are the
+    # arguments in the query string
+    def _key(self):
+        if request.path not in self.paths:
+            return None
+        body = request.get_data()
+        if request.is_json:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                pass
+            else:
+                if self.ignored_props and isinstance(data, dict):
+                    data = drop_values(data, self.ignored_props)
+                body = json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        args = tuple(sorted(request.args.items(multi=True)))
+        return (request.method, request.path, args, hashlib.sha1(body).hexdigest())
+
+    def before_request(self):
+        key = self._key()
+        if key is None:
+            return None
+
+        version = self.get_version()
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None:
+            self.misses += 1
+            setattr(g, self.g_name, (key, version))
+            return None
+        self.hits += 1
+        return entry.make_response(self.app.response_class)
+
+    def after_request(self, response):
+        current = g.get(self.g_name)
+        if (current is None or response.status_code != 200
+                or response.direct_passthrough or 'Content-Encoding' in response.headers):
+            return response
+
+        key, version = current
+
+        entry = CachedResponse(response.get_data(), response.mimetype, self.cache_control, 'fast')
+        with self.lock:
+            # The response belongs to the version when the request came in;
+            # if the data was swapped since, it isn't kept
+            if self.version == version:
+                self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry.make_response(self.app.response_class)
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'size': len(self.entries),
+            'bytes': sum(x.size for x in list(self.entries.values())),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -1,15 +1,30 @@
-import csv
 import json
+import os
 import re
+import time
 
+import click
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
-import plotly.graph_objs as go
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from flask import Response, abort, jsonify, request
 
-from app import dash_app
+from app import app, dash_app, postfork, uwsgi
+from app.atlas import Atlas, FigureLRU, load_definitions
+from app.bulk import FORMATS, DatasetExports, category_list
+from app.cache import SerializedCache, data_version
+from app.dataset import DATASET_FILE, Dataset, DatasetError, DataWatcher, empty_dataset, load_dataset
+from app.embed import publish_plotlyjs, render_atlas, render_embed
+from app.figures import category_figure, evenly_spaced
+from app.geometry import SMALL_SCREEN_LOD, SMALL_SCREEN_QUERY, optimized_geojson_path, publish_geojson
+from app.images import MANIFEST_FILE, MapImages, figure_hash, load_manifest
+from app.metrics import Metrics
+from app.query import QueryError, StatusIndex, count, members, slugify
+from app.responses import CLICK_PROPS, ResponseCache
+from app.serviceworker import DATA_VERSION_HEADER, render_service_worker
+from app.snapshots import SNAPSHOTS_FILE, align_categories, load_snapshots
 
 
 # Info about each category
@@ -97,37 +112,48 @@ color_map = {
 }
 
 
-# Load the data containing the results of all categories and countries
-ubo_data = []
-with open('app/static/ubo_atlas_data.csv') as IN:
-    ubo_data = [dict(x) for x in list(csv.DictReader(IN))]
-
-# Load the data containing the tooltips for results
-ubo_data_tooltips = []
-with open('app/static/ubo_atlas_data_tooltips.csv') as IN:
-    ubo_data_tooltips = [dict(x) for x in list(csv.DictReader(IN))]
-
-# Load the data containing the results about data fields
-ubo_data_fields = []
-with open('app/static/ubo_atlas_data_fields.csv') as IN:
-    ubo_data_fields = list(csv.DictReader(IN))
-
-# Add the data from the data fields CSV to ubo_data and ubo_data_tooltips
-for row1 in ubo_data_fields:
-    for row2 in ubo_data:
-        if row1['Country'] == row2['Country']:
-            row2['Data fields'] = row1['Ranking']
-    for row2 in ubo_data_tooltips:
-        if row1['Country'] == row2['Country']:
-            row2['Data fields'] = (
-                f"Name: {row1['Name']}<br>"
-                f"Month and year of birth: {row1['Month and year of birth']}<br>"
-                f"Country of residence: {row1['Country of residence']}<br>"
-                f"Nationality: {row1['Nationality']}<br>"
-                f"Nature of interest: {row1['Nature of interest']}<br>"
-                f"Extent of interest: {row1['Extent of interest']}<br>"
-                f"Additional information: {row1['Additional information']}<br>"
-            )
+# Files containing the data shown in the atlas
+DATA_FILE = 'app/static/ubo_atlas_data.csv'
+DATA_TOOLTIPS_FILE = 'app/static/ubo_atlas_data_tooltips.csv'
+DATA_FIELDS_FILE = 'app/static/ubo_atlas_data_fields.csv'
+GEOJSON_SOURCE_FILE = 'data/custom.geo-50m-europe41.json'
+
+# Use the optimized geometry created by `flask build-geometry` if available
+GEOJSON_FILE = optimized_geojson_path(app.config['UBO_GEOMETRY_LOD'])
+if not os.path.exists(GEOJSON_FILE):
+    GEOJSON_FILE = GEOJSON_SOURCE_FILE
+
+# Part of the world shown on the map
+LAT_RANGE = [38, 70]
+LON_RANGE = [-24, 34]
+
+
+# Timings of the requests, the callbacks and loading the data, the sizes of
+# the responses and the hit rates of the caches, for Prometheus on /metrics
+# (see app/metrics.py)
+metrics = Metrics(app.config['UBO_METRICS_DIR'], app.config['UBO_METRICS_INTERVAL'])
+metrics.gauge('ubo_data_load_seconds', 'Time the last load of the data took, per stage.')
+metrics.counter('ubo_cache_hits_total', 'Lookups answered from a cache.')
+metrics.counter('ubo_cache_misses_total', 'Lookups not answered from a cache.')
+
+# Load the data of all categories and countries, compiled from the CSVs by
+# `flask compile-data` (see app/dataset.py). CLI commands also import this
+# module, so when the CSVs are invalid and were never compiled they start
+# without data instead of failing here, and `flask compile-data` can report
+# the problems.
+load_start = time.perf_counter()
+try:
+    dataset = load_dataset([DATA_FILE, DATA_TOOLTIPS_FILE, DATA_FIELDS_FILE], ubo_info, logger=app.logger)
+except DatasetError as e:
+    if click.get_current_context(silent=True) is None:
+        raise
+    app.logger.error(f'{e}\nStarting without data')
+    dataset = empty_dataset(ubo_info)
+metrics.set('ubo_data_load_seconds', time.perf_counter() - load_start, stage='dataset')
+
+# Bitsets of the countries per result of each category, to answer queries
+# combining categories (see app/query.py)
+status_index = StatusIndex(dataset, ubo_info)
 
 def create_legend(i):
     return i
@@ -171,39 +197,70 @@ def update_collapse_item(i):
 
 
 # Data from https://geojson-maps.ash.ms/: medium resolution (50m),
-# Europe, deselected countries we don't need and included Cyprus
-with open('data/custom.geo-50m-europe41.json') as IN:
-    countries = json.load(IN)
+# Europe, deselected countries we don't need and included Cyprus (optimized
+# by `flask build-geometry`, see app/geometry.py).
+# The geometry is the bulk of a figure, so by default it is sent to the
+# browser only once as a static file and the figures merely refer to its URL;
+# the file is then published without parsing it, which saves startup time
+if app.config['UBO_GEOJSON_MODE'] == 'asset':
+    with open(GEOJSON_FILE, 'rb') as IN:
+        geojson = publish_geojson(IN.read())
+else:
+    with open(GEOJSON_FILE) as IN:
+        geojson = json.load(IN)
+
+# Small screens load the mobile level of detail of the geometry instead, if it
+# has been built: the pages get the URLs of both files and pick one for the
+# screen they are shown on (see for_screen in assets/clientside.js), so the
+# figures stay the same for all clients
+small_screen_geometry = {}
+SMALL_SCREEN_GEOJSON_FILE = optimized_geojson_path(SMALL_SCREEN_LOD)
+if (app.config['UBO_GEOJSON_MODE'] == 'asset' and GEOJSON_FILE != SMALL_SCREEN_GEOJSON_FILE
+        and os.path.exists(SMALL_SCREEN_GEOJSON_FILE)):
+    with open(SMALL_SCREEN_GEOJSON_FILE, 'rb') as IN:
+        small_screen_geometry[geojson] = publish_geojson(IN.read(), name=f'countries-{SMALL_SCREEN_LOD}')
 
 
 # Update the choropleth map
+# The figures are built as plain dicts instead of with the validating
+# plotly.graph_objs classes, which are slow to import and to instantiate; set
+# UBO_VALIDATE_FIGURES to check them with Plotly's validators when building
 def update_choropleth(current_result):
+    figure = build_choropleth(current_result)
+    if app.config['UBO_VALIDATE_FIGURES']:
+        import plotly.graph_objs as go
+        go.Figure(figure)
+    return figure
+
+
+def build_choropleth(current_result):
     # Show this text when the pages is loaded
     if current_result == 'start':
         return {
             'data': [
-                go.Choropleth(
+                {
+                    'type': 'choropleth',
                     # This specifies that we provide our own geojson
-                    locationmode='geojson-id',
-                    # Provide our own custom geojson
-                    geojson=countries,
+                    'locationmode': 'geojson-id',
+                    # Provide our own custom geojson (or the URL to it)
+                    'geojson': geojson,
                     # Specify the key in the geojson containing the country
                     # ISO 3166-1 alpha-3 code
-                    featureidkey='properties.iso_a3',
+                    'featureidkey': 'properties.iso_a3',
                     # ISO 3166-1 alpha-3 code of the countries we want to show,
                     # e.g., ['AUT', 'BEL', 'BGR', ...]
-                    showscale=False,
-                )
+                    'showscale': False,
+                }
             ],
-            'layout': go.Layout(
-                geo={
+            'layout': {
+                'geo': {
                     'scope': 'europe',
                     'domain': {
                         'x': [0, 1],
                         'y': [0, 1]
                     },
-                    'lataxis': {'range': [38, 70]},
-                    'lonaxis': {'range': [-24, 34]},
+                    'lataxis': {'range': LAT_RANGE},
+                    'lonaxis': {'range': LON_RANGE},
                     'showcoastlines': False,
                     'resolution': 50,
                     'showframe': False,
@@ -212,10 +269,10 @@ def update_choropleth(current_result):
                     'showocean': True,
                     'oceancolor': '#FFF0E6',
                 },
-                dragmode=False,
-                margin=go.layout.Margin(l=0, r=0, t=0, b=0),
-                font={'family': "'Mulish', sans-serif"},
-                annotations=[
+                'dragmode': False,
+                'margin': {'l': 0, 'r': 0, 't': 0, 'b': 0},
+                'font': {'family': "'Mulish', sans-serif"},
+                'annotations': [
                     {
                         'align': 'left',
                         'font': dict(
@@ -241,66 +298,368 @@ def update_choropleth(current_result):
                         )
                     }
                 ]
-            )
+            }
         }
 
-    # Results value for each country, e.g. [1, 1, 4, 3, ...]
-    results = [ubo_info[current_result]['status'][x[ubo_info[current_result]['title']]] for x in ubo_data]
+    return category_figure(dataset, current_result, geojson, color_map, LAT_RANGE, LON_RANGE)
+
+
+# The figures only depend on the data files, so build all of them once per
+# data version instead of on every click in the category menu
+load_start = time.perf_counter()
+geometry_version = data_version([GEOJSON_FILE] + ([SMALL_SCREEN_GEOJSON_FILE] if small_screen_geometry else []))
+figure_cache = SerializedCache(update_choropleth)
+figure_cache.load(
+    data_version([], geometry_version, dataset.version),
+    ['start'] + list(range(0, len(ubo_info)))
+)
+
+
+# Properties of the trace which differ between the figures of the
+# categories; everything else in these figures is the same
+CATEGORY_TRACE_KEYS = ('z', 'colorscale', 'text')
+
+
+# The trace (without the properties above) and the layout shared by the
+# figures of all categories
+def build_figure_base():
+    figure = figure_cache.get(0)
     return {
-        'data': [
-            go.Choropleth(
-                # This specifies that we provide our own geojson
-                locationmode='geojson-id',
-                # Provide our own custom geojson
-                geojson=countries,
-                # Specify the key in the geojson containing the country
-                # ISO 3166-1 alpha-3 code
-                featureidkey='properties.iso_a3',
-                # ISO 3166-1 alpha-3 code of the countries we want to show,
-                # e.g., ['AUT', 'BEL', 'BGR', ...]
-                locations=[x['Country code'] for x in ubo_data],
-                z=results,
-                showscale=False,
-                # Only retrieve the colors that are actually used in a map,
-                # otherwise gradients of the colors might be used
-                colorscale=[color_map[x] for x in list(set(sorted(results)))],
-                # Provide text for the tooltips
-                text=[
-                    '<b>{0}</b>: {1}<br>{2}'.format(
-                            x['Country'],
-                            # Result
-                            x[ubo_info[current_result]['title']],
-                            # Retrieve any extra tooltip info
-                            ubo_data_tooltips[idx][ubo_info[current_result]['title']]
-                        ) for idx, x in enumerate(ubo_data)
-                ],
-                hoverinfo="text",
-            )
-        ],
-        'layout': go.Layout(
-            geo={
-                'scope': 'europe',
-                'domain': {
-                    'x': [0, 1],
-                    'y': [0, 1]
-                },
-                'lataxis': {'range': [38, 70]},
-                'lonaxis': {'range': [-24, 34]},
-                'showcoastlines': False,
-                'resolution': 50,
-                'showframe': False,
-                'projection': {'type': 'mercator'},
-                'showland': False,
-                'showocean': True,
-                'oceancolor': '#FFF0E6',
-            },
-            showlegend=False,
-            margin=go.layout.Margin(l=0, r=0, t=0, b=0),
-            font={'family': "'Montserrat', sans-serif"},
+        'trace': {key: value for key, value in figure['data'][0].items() if key not in CATEGORY_TRACE_KEYS},
+        'layout': figure['layout'],
+    }
+
+
+# Everything the browser needs to switch categories by itself when the
+# clientside callback engine is used: the start figure, the trace and layout
+# shared by all categories and per category only the values that differ
+def build_category_data():
+    figures = [figure_cache.get(x) for x in range(0, len(ubo_info))]
+    return dict(
+        build_figure_base(),
+        start=figure_cache.get('start'),
+        categories=[
+            {key: figure['data'][0][key] for key in CATEGORY_TRACE_KEYS} for figure in figures
+        ]
+    )
+
+
+# What update_home_page sends to show a figure: the whole figure for the
+# start page, but for a category only the properties of the trace which
+# differ between the categories. The browser merges those into the figure
+# base it got along with the page (see update_choropleth in
+# assets/clientside.js), so the layout and geometry are only sent once.
+def build_figure_update(key):
+    figure = figure_cache.get(key)
+    if key == 'start':
+        return {'figure': figure}
+    return {'trace': {name: figure['data'][0][name] for name in CATEGORY_TRACE_KEYS}}
+
+
+# The figure the browser shows after merging an update into the figure base
+def apply_figure_update(update, base):
+    if 'figure' in update:
+        return update['figure']
+    return {'data': [dict(base['trace'], **update['trace'])], 'layout': base['layout']}
+
+
+figure_update_cache = SerializedCache(build_figure_update)
+
+# The filter page uses the figure base with both engines
+figure_base = build_figure_base()
+if app.config['UBO_CALLBACK_ENGINE'] == 'clientside':
+    category_data = build_category_data()
+else:
+    figure_update_cache.load(figure_cache.version, ['start'] + list(range(0, len(ubo_info))))
+metrics.set('ubo_data_load_seconds', time.perf_counter() - load_start, stage='figures')
+
+
+# Name of the map of a figure in the image manifest (see app/images.py), i.e.
+# 'start' or the slug of the category
+def map_name(key):
+    return key if key == 'start' else status_index.slugs[key]
+
+
+# The prerendered images of the maps which match the current figures (see
+# `flask render-maps`); returns whether they changed
+def load_map_images():
+    global map_images
+    keys = ['start'] + list(range(0, len(ubo_info)))
+    new_map_images = MapImages(
+        load_manifest(), {map_name(key): figure_hash(figure_cache.get_json(key)) for key in keys}
+    )
+    changed = new_map_images.version != map_images.version
+    map_images = new_map_images
+    return changed
+
+
+map_images = MapImages({}, {})
+load_map_images()
+
+
+# History of the data: the snapshots recorded by `flask compile-data` (see
+# app/snapshots.py), oldest first and ending with the current data (added if
+# it wasn't recorded yet), with the date of each snapshot (None for the
+# current data if it wasn't recorded). The time slider on the home page shows
+# the maps of the categories at each snapshot.
+snapshot_datasets = [dataset]
+snapshot_dates = [None]
+history_version = None
+
+
+# The properties of the trace of a category (see CATEGORY_TRACE_KEYS) at an
+# earlier snapshot, plus the countries if they differ from the current ones
+def build_snapshot_trace(key):
+    snapshot, category = key
+    figure = category_figure(snapshot_datasets[snapshot], category, geojson, color_map, LAT_RANGE, LON_RANGE)
+    trace = {name: figure['data'][0][name] for name in CATEGORY_TRACE_KEYS}
+    if snapshot_datasets[snapshot].codes != dataset.codes:
+        trace['locations'] = snapshot_datasets[snapshot].codes
+    return trace
+
+
+# The traces of all categories at all earlier snapshots, which only change
+# with the history, so moving the time slider never builds a figure
+snapshot_trace_cache = SerializedCache(build_snapshot_trace)
+
+
+# Load the history again and rebuild the traces of the earlier snapshots if
+# it changed; returns whether it changed
+def load_history():
+    global snapshot_datasets, snapshot_dates, history_version
+    snapshots = load_snapshots()
+    if not snapshots or snapshots[-1][1]['version'] != dataset.version:
+        snapshots.append((None, None))
+    dates = [date for date, _ in snapshots]
+    datasets = [Dataset(align_categories(compiled, ubo_info)) for _, compiled in snapshots[:-1]] + [dataset]
+    version = data_version([], figure_cache.version, json.dumps([[x.version for x in datasets], dates]))
+    if version == history_version:
+        return False
+
+    snapshot_datasets, snapshot_dates, history_version = datasets, dates, version
+    if app.config['UBO_CALLBACK_ENGINE'] != 'clientside':
+        snapshot_trace_cache.load(
+            version, [(x, y) for x in range(0, len(datasets) - 1) for y in range(0, len(ubo_info))]
         )
+    return True
+
+
+# Position on the time slider sent by a client as an int, clamped to the
+# snapshots of the history, or None if it isn't a number (which shows the
+# current data)
+def snapshot_position(value):
+    try:
+        position = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return min(max(position, 0), len(snapshot_datasets) - 1)
+
+
+# The trace properties of a category at a snapshot (by its position on the
+# time slider); the latest snapshot is the current data
+def snapshot_trace(snapshot, category):
+    if snapshot is None or not 0 <= snapshot < len(snapshot_datasets) - 1:
+        return figure_update_cache.get(category)['trace']
+    return snapshot_trace_cache.get((snapshot, category))
+
+
+# What update_snapshot sends when the time slider moves from one snapshot to
+# another while a category is shown: only the positions, results and
+# tooltips of the countries whose result or tooltip differs between the
+# snapshots (and the colorscale). The browser changes those in the figure it
+# shows (see update_home_choropleth in assets/clientside.js). If the
+# snapshots have different countries the whole trace is sent like a figure
+# update instead.
+def build_snapshot_delta(source, target, category):
+    old, new = snapshot_trace(source, category), snapshot_trace(target, category)
+    if old.get('locations') != new.get('locations'):
+        return {'trace': new}
+    indexes = [
+        i for i, (z, text) in enumerate(zip(new['z'], new['text'])) if (z, text) != (old['z'][i], old['text'][i])
+    ]
+    return {
+        'indexes': indexes,
+        'z': [new['z'][i] for i in indexes],
+        'text': [new['text'][i] for i in indexes],
+        'colorscale': new['colorscale'],
     }
 
 
+load_start = time.perf_counter()
+load_history()
+metrics.set('ubo_data_load_seconds', time.perf_counter() - load_start, stage='history')
+
+
+# Load the data again after the data files changed and swap it in; only the
+# figures of categories whose data actually changed are rebuilt, and requests
+# keep getting the previous figures until the new ones are all ready
+def reload_data():
+    global dataset, status_index, category_data, figure_base
+    start = time.perf_counter()
+    try:
+        new_dataset = load_dataset([DATA_FILE, DATA_TOOLTIPS_FILE, DATA_FIELDS_FILE], ubo_info, fallback=False)
+    except DatasetError as e:
+        # Keep the data in use, which may be newer than the compiled data
+        app.logger.error(f'{e}\nKeeping data version {dataset.version}')
+        return
+    if new_dataset.version == dataset.version:
+        # Only the images of the maps or the history may have changed
+        reloaded = [name for name, changed in (('images of the maps', load_map_images()), ('history', load_history())) if changed]
+        if reloaded:
+            load_layouts()
+            app.logger.info(f"Reloaded the {' and the '.join(reloaded)}")
+        return
+    metrics.set('ubo_data_load_seconds', time.perf_counter() - start, stage='dataset')
+
+    start = time.perf_counter()
+    changed = new_dataset.changed_categories(dataset)
+    dataset = new_dataset
+    status_index = StatusIndex(dataset, ubo_info)
+    figure_cache.load(
+        data_version([], geometry_version, dataset.version),
+        ['start'] + list(range(0, len(ubo_info))),
+        changed=changed
+    )
+    figure_base = build_figure_base()
+    if app.config['UBO_CALLBACK_ENGINE'] == 'clientside':
+        category_data = build_category_data()
+    else:
+        figure_update_cache.load(figure_cache.version, ['start'] + list(range(0, len(ubo_info))), changed=changed)
+    metrics.set('ubo_data_load_seconds', time.perf_counter() - start, stage='figures')
+    load_map_images()
+    load_history()
+    load_layouts()
+    app.logger.info(f'Reloaded data version {dataset.version}, changed categories: {changed}')
+
+
+if app.config['UBO_DATA_RELOAD_INTERVAL']:
+    data_watcher = DataWatcher(
+        [DATA_FILE, DATA_TOOLTIPS_FILE, DATA_FIELDS_FILE, DATASET_FILE, MANIFEST_FILE, SNAPSHOTS_FILE],
+        app.config['UBO_DATA_RELOAD_INTERVAL'],
+        reload_data,
+        app.logger
+    )
+    postfork(data_watcher.start)
+
+
+# Label the requests of the callback endpoint with the name of the callback
+# and, for the category menu, with the category which was clicked ('start'
+# when the home page is first rendered), to see how often each is requested.
+# The fields are taken from the body with regular expressions, which is a lot
+# faster than decoding the whole body for every request.
+def callback_labels():
+    if request.path != dash_app.config.routes_pathname_prefix + '_dash-update-component':
+        return {}
+    body = request.get_data(as_text=True)
+    output = re.search(r'"output"\s*:\s*"([^"]*)"', body)
+    callback = dash_app.callback_map.get(output.group(1) if output else None, {}).get('callback')
+    if callback is None:
+        return {'callback': 'none'}
+    labels = {'callback': callback.__name__}
+    if callback.__name__ == 'update_home_page':
+        match = re.search(r'"changedPropIds"\s*:\s*\[\s*"group-(\d+)-toggle', body)
+        if match is None:
+            labels['category'] = 'start'
+        elif int(match.group(1)) < len(ubo_info):
+            labels['category'] = str(int(match.group(1)))
+        else:
+            # Any client can send any number, which must not add a series to
+            # the metrics per number
+            labels['category'] = 'invalid'
+    return labels
+
+
+metrics.init_app(app, callback_labels)
+
+# Every worker starts with empty metrics, also when forked from a process
+# which already handled requests (see app/preload.py), and the uWSGI workers
+# share theirs through the metrics directory, where the files of the workers
+# of previous runs of uWSGI are removed
+postfork(metrics.reset)
+if uwsgi:
+    postfork(lambda: metrics.start(since=uwsgi.started_on))
+
+
+# The responses of the Dash endpoints only depend on the request and the data
+# (including the images of the maps the pages refer to and the history), so
+# keep them
+# (compressed) per data version and answer repeated requests from the cache,
+# including 304s for clients sending If-None-Match. The click counts of the
+# category menu are left out of the keys, as update_home_page only looks at
+# which category was clicked. The version is that of the layouts, which are
+# built last whenever the data, the images of the maps or the history are
+# reloaded (see load_layouts), so it only changes once everything the
+# responses are built from has been swapped in.
+def responses_version():
+    return layout_cache.version
+
+
+# Tell the service worker which data version a response belongs to, so it
+# can drop the responses it keeps of other versions (see app/serviceworker.py).
+# Flask runs the after request hooks in reverse, so registering this one
+# before the response cache makes it run on the response the cache returns
+# instead of the response of the view, which the cache replaces.
+@app.after_request
+def data_version_header(response):
+    response.headers[DATA_VERSION_HEADER] = data_version([], responses_version())[:16]
+    return response
+
+
+response_cache = ResponseCache(
+    responses_version,
+    [
+        dash_app.config.routes_pathname_prefix + '_dash-layout',
+        dash_app.config.routes_pathname_prefix + '_dash-dependencies',
+        dash_app.config.routes_pathname_prefix + '_dash-update-component',
+        '/api/v1/categories',
+        '/api/v1/query',
+        '/sw.js',
+    ] + [f'/embed/{slug}' for slug in status_index.slugs],
+    max_entries=app.config['UBO_RESPONSE_CACHE_SIZE'],
+    ignored_props=CLICK_PROPS
+)
+response_cache.init_app(app)
+
+
+# The service worker caching the bundles, figures and geometry in the browser,
+# registered by assets/serviceworker.js; it is served from the root, as it
+# can only handle the requests of pages below its own path. It lists the
+# files the index page refers to, which change with the code and the images
+# of the maps, so it is kept by the response cache.
+@app.route('/sw.js')
+def service_worker():
+    script = render_service_worker(
+        dash_app.index(),
+        app.static_folder,
+        dash_app.config.routes_pathname_prefix + '_dash-update-component',
+        [dash_app.config.routes_pathname_prefix + '_dash-layout', dash_app.config.routes_pathname_prefix + '_dash-dependencies'],
+        enabled=app.config['UBO_SERVICE_WORKER']
+    )
+    return Response(script, mimetype='application/javascript')
+
+
+# The pages show the image of the start map (see app/images.py) while the
+# scripts load, and to clients without JavaScript, in place of Dash's loading
+# message. They keep the generic og:image, the categories have their own on
+# their embed pages.
+def interpolate_index(**kwargs):
+    png, webp = map_images.url('start'), map_images.url('start', 'webp')
+    if png:
+        kwargs['app_entry'] = (
+            '<div id="react-entry-point"><div class="_dash-loading">'
+            f'<picture><source type="image/webp" srcset="{webp}">'
+            f'<img src="{png}" class="img-fluid" alt="Map of the UBO registers across the EU"></picture>'
+            '</div></div>'
+        )
+    # The geometry for small screens, before the scripts which use it
+    geometry = json.dumps({'query': SMALL_SCREEN_QUERY, 'urls': small_screen_geometry}).replace('</', '<\\/')
+    kwargs['scripts'] = f'<script>window.uboGeometry = {geometry};</script>\n' + kwargs['scripts']
+    return dash.Dash.interpolate_index(dash_app, **kwargs)
+
+
+dash_app.interpolate_index = interpolate_index
+
+
 # Main layout of the dash app
 dash_app.layout = html.Div(
     [
@@ -310,6 +669,7 @@ dash_app.layout = html.Div(
         # Navbar
         dbc.NavbarSimple(
             children=[
+                dbc.NavItem(dbc.NavLink("Filter", href="/filter")),
                 dbc.NavItem(dbc.NavLink("About", href="/about")),
             ],
             brand=" ",
@@ -404,6 +764,19 @@ about_layout = html.Div(
                 href='/static/ubo_atlas_data_tooltips.csv'
             ),
         ),
+        html.P(
+            [
+                'Joined dataset: ',
+                html.A('csv', href='/api/v1/dataset.csv'),
+                ', ',
+                html.A('json', href='/api/v1/dataset.json'),
+                ', ',
+                html.A('ndjson', href='/api/v1/dataset.ndjson'),
+                ' (see ',
+                html.A('/api/v1/', href='/api/v1/'),
+                ')',
+            ]
+        ),
         html.Br(),
         html.Br(),
     ],
@@ -411,15 +784,37 @@ about_layout = html.Div(
 )
 
 
-# Page routing callback
+# Page routing callback; the content of each page is built and serialized
+# once per data version (see layout_cache below)
 @dash_app.callback(
     Output('page-content', 'children'),
     [Input('url', 'pathname')]
 )
 def display_page(pathname):
+    return layout_cache.get(page_key(pathname))
+
+
+# Key of the page at a path in the layout cache, which is also the path of
+# the page's content as any unknown path shows the home page
+def page_key(pathname):
+    return pathname if pathname in ('/about', '/filter') else '/'
+
+
+# Configuration of the maps
+graph_config = {
+    'modeBarButtonsToRemove': ["select2d", "lasso2d", "pan2d", "zoom2d", "autoScale2d", "resetScale2d"],
+    'scrollZoom': False
+}
+
+
+# Content of the page at a path
+def page_content(pathname):
     # About page
     if pathname == '/about':
         return about_layout
+    # Filter page
+    elif pathname == '/filter':
+        return filter_page_content()
     # Home page
     else:
         return html.Div(
@@ -431,16 +826,15 @@ def display_page(pathname):
                         # Category menu on the left
                         html.Div([update_collapse_item(x) for x in range(0, len(ubo_info))], className="accordion col-12 col-md-4"),
 
-                        # Choropleth
+                        # Choropleth, showing the image of the start map (if
+                        # any) until Plotly has been loaded and drawn the map
                         dcc.Graph(
                             id='choropleth',
-                            config={
-                                'modeBarButtonsToRemove': ["select2d", "lasso2d", "pan2d", "zoom2d", "autoScale2d", "resetScale2d"],
-                                'scrollZoom': False
-                            },
-                            className="col-12 col-md-8 bg-orange"
+                            config=graph_config,
+                            className="col-12 col-md-8 bg-orange",
+                            style=placeholder_style('start')
                         )
-                    ],
+                    ] + history_controls() + home_page_stores(),
                     className="row"
                 )
             ],
@@ -448,28 +842,460 @@ def display_page(pathname):
         )
 
 
+# Style showing the image of a map as background of its graph, which Plotly
+# covers once it has drawn the map
+def placeholder_style(name):
+    url = map_images.url(name)
+    if url is None:
+        return None
+    return {
+        'backgroundImage': f'url({url})',
+        'backgroundSize': 'contain',
+        'backgroundRepeat': 'no-repeat',
+        'backgroundPosition': 'center',
+    }
+
+
+# Data which is sent along with the home page, i.e. the data of all
+# categories when the browser switches categories itself, otherwise the
+# figure base and a store receiving the figure updates from the server
+def home_page_stores():
+    if app.config['UBO_CALLBACK_ENGINE'] == 'clientside':
+        return [dcc.Store(id='category-data', data=category_data)]
+    return [dcc.Store(id='choropleth-base', data=figure_base), dcc.Store(id='choropleth-update')]
+
+
+# Time slider below the map to show the data at an earlier snapshot of the
+# history, which needs the server; hidden while there is only one snapshot.
+# The 'snapshot-shown' store holds the snapshot the map currently shows, which
+# update_snapshot sends the changes from.
+def history_controls():
+    if app.config['UBO_CALLBACK_ENGINE'] == 'clientside':
+        return []
+    latest = len(snapshot_datasets) - 1
+    return [
+        html.Div(
+            dcc.Slider(
+                id='snapshot-slider',
+                min=0,
+                max=latest,
+                step=None,
+                value=latest,
+                marks={i: date or 'now' for i, date in enumerate(snapshot_dates)},
+                updatemode='drag'
+            ),
+            id='snapshot-control',
+            className="col-12 col-md-8 offset-md-4",
+            style=None if latest else {'display': 'none'}
+        ),
+        dcc.Store(id='snapshot-shown', data=latest),
+        dcc.Store(id='choropleth-delta'),
+    ]
+
+
 # Callback that changes the choropleth and category menu based on a
-# click on an item in the category menu; the first return value goes to the
-# choropleth element, the remaining return values go to the collape elements
-# and state if they should be opened or not using True/False values
-@dash_app.callback(
-    [Output('choropleth', 'figure')] + [Output(f"collapse-{i}", "is_open") for i in range(0, len(ubo_info))],
-    [Input(f"group-{i}-toggle", "n_clicks") for i in range(0, len(ubo_info))],
-)
+# click on an item in the category menu; the first return value is the
+# figure update for the choropleth (see build_figure_update), the remaining
+# return values go to the collape elements and state if they should be
+# opened or not using True/False values. The map shows the category at the
+# snapshot selected with the time slider. The clientside engine returns the
+# whole figure to the choropleth instead and always shows the current data.
+collapse_outputs = [Output(f"collapse-{i}", "is_open") for i in range(0, len(ubo_info))]
+home_page_outputs = [Output('choropleth-update', 'data')] + collapse_outputs
+clientside_home_page_outputs = [Output('choropleth', 'figure')] + collapse_outputs
+home_page_inputs = [Input(f"group-{i}-toggle", "n_clicks") for i in range(0, len(ubo_info))]
+
+
 def update_home_page(*args):
     ctx = dash.callback_context
+    # Position of the time slider (the only State)
+    snapshot = snapshot_position(args[-1])
 
     # Output for the default state when the page is first rendered, i.e.
     # open the first category and show its corresponding map
     if not ctx.triggered:
-        return (update_choropleth('start'),) + (False,) * (len(ubo_info))
+        return (figure_update_cache.get('start'),) + (False,) * (len(ubo_info))
     else:
         button_id = ctx.triggered[0]["prop_id"].split(".")[0]
 
     # Depending on the clicked category, open that category and show that map
     group_number = int(re.match(r'group-(\d+)-toggle', button_id).group(1))
-    return (update_choropleth(group_number),) + tuple(True if group_number == x else False for x in range(0, len(ubo_info)))
+    return ({'trace': snapshot_trace(snapshot, group_number)},) + tuple(True if group_number == x else False for x in range(0, len(ubo_info)))
+
+
+snapshot_outputs = [Output('choropleth-delta', 'data'), Output('snapshot-shown', 'data')]
+snapshot_inputs = [Input('snapshot-slider', 'value')]
+snapshot_states = [State('snapshot-shown', 'data')] + [State(f'collapse-{i}', 'is_open') for i in range(0, len(ubo_info))]
+
+
+# Callback showing the snapshot selected with the time slider: sends the
+# changes to the map if a category is shown (see build_snapshot_delta) and
+# remembers the snapshot as the one shown. Nothing changes for a position
+# which isn't a number.
+def update_snapshot(snapshot, shown, *is_open):
+    snapshot, shown = snapshot_position(snapshot), snapshot_position(shown)
+    if snapshot is None:
+        return dash.no_update, dash.no_update
+    category = next((i for i, x in enumerate(is_open) if x), None)
+    if category is None or snapshot == shown:
+        return dash.no_update, snapshot
+    return build_snapshot_delta(shown, snapshot, category), snapshot
+
+
+# Content of the filter page: a menu to select results of the categories and
+# a map showing the countries which have them
+def filter_page_content():
+    return html.Div(
+        [
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.Br(),
+                            html.P('Select results in one or more categories to see which countries have all of them (and any of the selected results within a category).'),
+                        ] + [
+                            html.Div(
+                                [
+                                    html.Label(category['title'], htmlFor=f'filter-{i}'),
+                                    dcc.Dropdown(
+                                        id=f'filter-{i}',
+                                        options=[{'label': value, 'value': slugify(value)} for value in category['status']],
+                                        multi=True
+                                    ),
+                                    html.Br(),
+                                ]
+                            ) for i, category in enumerate(ubo_info)
+                        ] + [
+                            html.P(id='filter-summary'),
+                        ],
+                        className="col-12 col-md-4"
+                    ),
+                    dcc.Graph(
+                        id='filter-map',
+                        config=graph_config,
+                        className="col-12 col-md-8 bg-orange"
+                    ),
+                    dcc.Store(id='filter-map-base', data=figure_base),
+                    dcc.Store(id='filter-map-update'),
+                ],
+                className="row"
+            )
+        ],
+        className="container-fluid"
+    )
+
+
+# Figure update (see build_figure_update) of the filter map for a query: the
+# matching countries get the color of status 1, the others that of status 0,
+# and the tooltips show the results of the selected categories
+def build_filter_update(index, query, bits):
+    z = [(bits >> i) & 1 for i in range(0, index.size)]
+    return {
+        'trace': {
+            'z': z,
+            'colorscale': evenly_spaced([color_map[x] for x in sorted(set(z))]),
+            'text': [
+                '<b>{0}</b>: {1}'.format(name, 'match' if match else 'no match') + ''.join(
+                    '<br>{0}: {1}'.format(ubo_info[category]['title'], index.dataset.categories[category]['values'][i])
+                    for category, _ in query
+                ) for i, (name, match) in enumerate(zip(index.dataset.names, z))
+            ],
+        }
+    }
+
+
+filter_page_outputs = [Output('filter-map-update', 'data'), Output('filter-summary', 'children')]
+filter_inputs = [Input(f'filter-{i}', 'value') for i in range(0, len(ubo_info))]
+
+
+# Show the countries having the results selected in the menu of the filter
+# page on its map; the browser merges the update into the figure base like on
+# the home page
+@dash_app.callback(filter_page_outputs, filter_inputs)
+def update_filter_map(*values):
+    index = status_index
+    query = index.parse({index.slugs[i]: value for i, value in enumerate(values) if value})
+    bits = index.match(query)
+    return build_filter_update(index, query, bits), f'{count(bits)} of {index.size} countries match'
+
+
+dash_app.clientside_callback(
+    ClientsideFunction(namespace='ubo', function_name='update_choropleth'),
+    Output('filter-map', 'figure'),
+    [Input('filter-map-update', 'data')],
+    [State('filter-map-base', 'data')]
+)
+
+
+# The categories of an atlas and their results which can be used in queries
+def categories_response(index, categories):
+    return jsonify(version=index.version, categories=category_list(index, categories))
+
+
+# The countries of an atlas matching the query in the arguments of the
+# request, and the number of matching countries per status code of each
+# category
+def query_response(index):
+    try:
+        query = index.parse(request.args.to_dict(flat=False))
+    except QueryError as e:
+        return jsonify(error=str(e)), 400
+    bits = index.match(query)
+    return jsonify(
+        version=index.version,
+        query={index.slugs[category]: list(results) for category, results in query},
+        count=count(bits),
+        countries=[
+            {
+                'code': index.dataset.codes[i],
+                'name': index.dataset.names[i],
+                'status': {slug: index.status(category, i) for category, slug in enumerate(index.slugs)},
+            } for i in members(bits)
+        ],
+        status_counts=dict(zip(index.slugs, index.status_counts(bits)))
+    )
+
+
+# The endpoints of the API of an atlas at a path prefix
+def api_index_response(index, prefix=''):
+    return jsonify(
+        version=index.version,
+        endpoints={
+            'categories': f'{prefix}/api/v1/categories',
+            'query': f'{prefix}/api/v1/query',
+            'dataset': {name: f'{prefix}/api/v1/dataset.{name}' for name in FORMATS},
+        }
+    )
+
+
+@app.route('/api/v1/')
+def api_index():
+    return api_index_response(status_index)
 
 
+# The categories and their results which can be used in queries
+@app.route('/api/v1/categories')
+def categories_api():
+    return categories_response(status_index, ubo_info)
+
+
+# The countries matching a query, e.g. /api/v1/query?who-has-access=public&
+# paywall=no&structured-data-in-machine-readable-format=yes for the countries
+# with public access and no paywall which publish structured data. Results of
+# the same category may be combined (meaning any of them) by repeating the
+# argument or separating them by commas. Also returns the number of matching
+# countries per status code of each category.
+@app.route('/api/v1/query')
+def query_api():
+    return query_response(status_index)
+
+
+# The whole dataset in one request, joined per country like in the figures:
+# per category the result, its slug, status code and tooltip (an HTML
+# fragment). /api/v1/dataset.json also lists the categories and the data
+# version, /api/v1/dataset.ndjson has a line per country and
+# /api/v1/dataset.csv a row per country and category. Each format is rendered
+# and compressed once per data version (see app/bulk.py) and answered with a
+# 304 if the client sends the ETag of the current version.
+dataset_exports = DatasetExports()
+dataset_format = f"<any({', '.join(FORMATS)}):format>"
+
+
+@app.route(f'/api/v1/dataset.{dataset_format}')
+def dataset_api(format):
+    return dataset_exports.get(status_index, ubo_info, format).make_response(app.response_class)
+
+
+# Embeddable page with only the map of a category (by its slug, see
+# app/query.py), e.g. for an iframe in an article: the figure is in the page
+# itself and drawn by plotly.js without Dash, so the map shows after a single
+# request (plus the cacheable plotly.js bundle and geometry). The pages are
+# kept by the response cache like the responses of the Dash endpoints.
+plotlyjs_url = app.config['UBO_EMBED_PLOTLYJS_URL'] or publish_plotlyjs()
+
+
+@app.route('/embed/<slug>')
+def embed(slug):
+    if slug not in status_index.positions:
+        abort(404)
+    category = status_index.positions[slug]
+    return render_embed(
+        ubo_info[category]['title'],
+        figure_cache.get_json(category),
+        legend(ubo_info[category], color_map),
+        plotlyjs_url,
+        map_images.images.get(slug),
+        small_screen_geometry=small_screen_geometry
+    )
+
+
+# The (result, color) pairs of the legend of a category
+def legend(category, colors):
+    return [(value, colors[status]) for value, status in category['status'].items()]
+
+
+# Other atlases (e.g., other registers, regions or editions) served by the
+# same workers next to the UBO atlas, each under its own URL prefix, as
+# defined in the UBO_ATLASES file (see app/atlas.py). An atlas is only loaded
+# on the first request for it and the figures of all atlases share one LRU
+# bounded in bytes, so the memory of a worker stays predictable however many
+# atlases there are. They are served without Dash: a page listing the
+# categories, the embed page of each category and the query API.
+atlas_figures = FigureLRU(app.config['UBO_ATLAS_FIGURE_CACHE_BYTES'])
+atlases = {}
+if app.config['UBO_ATLASES']:
+    atlases = {
+        prefix: Atlas(
+            definition,
+            atlas_figures,
+            app.logger,
+            geojson_mode=app.config['UBO_GEOJSON_MODE'],
+            reload_interval=app.config['UBO_DATA_RELOAD_INTERVAL']
+        ) for prefix, definition in load_definitions(app.config['UBO_ATLASES']).items()
+    }
+
+# The responses of an atlas only depend on the request and its data, like
+# those of the UBO atlas; getting the version also loads the atlas and checks
+# its files for changes
+atlas_response_caches = {
+    prefix: ResponseCache(
+        lambda atlas=atlas: atlas.get()[0].version,
+        [f'/{atlas.prefix}/', f'/{atlas.prefix}/api/v1/categories', f'/{atlas.prefix}/api/v1/query'] + [
+            f"/{atlas.prefix}/embed/{slugify(category['title'])}" for category in atlas.categories
+        ],
+        max_entries=app.config['UBO_RESPONSE_CACHE_SIZE']
+    ) for prefix, atlas in atlases.items()
+}
+for cache in atlas_response_caches.values():
+    cache.init_app(app)
+
+if atlases:
+    # Only matches the prefixes of the atlases (quoted, as they may contain
+    # dashes), so all other paths still go to the UBO atlas
+    atlas_prefix = f"<any({', '.join(repr(x) for x in atlases)}):prefix>"
+
+    @app.route(f'/{atlas_prefix}/')
+    def atlas_page(prefix):
+        atlas = atlases[prefix]
+        return render_atlas(
+            atlas.title,
+            [
+                {
+                    'title': category['title'],
+                    'description': category.get('description', ''),
+                    'legend': legend(category, atlas.colors),
+                    'url': f'/{prefix}/embed/{slug}',
+                } for slug, category in zip(atlas.status_index.slugs, atlas.categories)
+            ],
+            f'/{prefix}/api/v1/categories'
+        )
+
+    @app.route(f'/{atlas_prefix}/embed/<slug>')
+    def atlas_embed(prefix, slug):
+        atlas = atlases[prefix]
+        if slug not in atlas.status_index.positions:
+            abort(404)
+        category = atlas.status_index.positions[slug]
+        return render_embed(
+            atlas.categories[category]['title'],
+            atlas.figure_json(category),
+            legend(atlas.categories[category], atlas.colors),
+            plotlyjs_url,
+            atlas_title=atlas.title,
+            atlas_url=f'/{prefix}/'
+        )
+
+    @app.route(f'/{atlas_prefix}/api/v1/categories')
+    def atlas_categories_api(prefix):
+        return categories_response(atlases[prefix].status_index, atlases[prefix].categories)
+
+    @app.route(f'/{atlas_prefix}/api/v1/query')
+    def atlas_query_api(prefix):
+        return query_response(atlases[prefix].status_index)
+
+    @app.route(f'/{atlas_prefix}/api/v1/')
+    def atlas_api_index(prefix):
+        return api_index_response(atlases[prefix].status_index, f'/{prefix}')
+
+    atlas_dataset_exports = {prefix: DatasetExports() for prefix in atlases}
+
+    @app.route(f'/{atlas_prefix}/api/v1/dataset.{dataset_format}')
+    def atlas_dataset_api(prefix, format):
+        atlas = atlases[prefix]
+        response = atlas_dataset_exports[prefix].get(atlas.status_index, atlas.categories, format)
+        return response.make_response(app.response_class)
+
+
+# The content of the pages only changes with the data (including the images
+# of the maps and the history), so keep it serialized per data version;
+# load_layouts() is called again, after everything else, whenever the data is
+# reloaded to replace the layouts of the previous version
+layout_cache = SerializedCache(page_content)
+
+
+def load_layouts():
+    start = time.perf_counter()
+    layout_cache.load(figure_cache.version + map_images.version + history_version, ['/', '/about', '/filter'])
+    metrics.set('ubo_data_load_seconds', time.perf_counter() - start, stage='layouts')
+
+
+load_layouts()
+
+
+# The hit/miss counters of all caches for /metrics, which every worker starts
+# from zero like the other metrics
+caches = {
+    'figure': figure_cache,
+    'figure_update': figure_update_cache,
+    'snapshot_trace': snapshot_trace_cache,
+    'layout': layout_cache,
+    'response': response_cache,
+    'atlas_figure': atlas_figures,
+}
+
+
+@metrics.collect
+def cache_metrics():
+    for name, cache in caches.items():
+        stats = cache.stats()
+        yield 'ubo_cache_hits_total', {'cache': name}, stats['hits']
+        yield 'ubo_cache_misses_total', {'cache': name}, stats['misses']
+
+
+@postfork
+def reset_cache_stats():
+    for cache in caches.values():
+        cache.hits = cache.misses = 0
+
+
+# Metrics of all workers in the Prometheus text format
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# The clientside engine runs the same logic in the browser (see
+# update_home_page in assets/clientside.js) using the data in the
+# 'category-data' store, so switching categories needs no requests at all.
+# Otherwise the browser merges the figure updates of update_home_page into
+# the figure base, and the changes update_snapshot sends into the figure it
+# shows, so Plotly updates the existing map with just the values that
+# changed.
+if app.config['UBO_CALLBACK_ENGINE'] == 'clientside':
+    dash_app.clientside_callback(
+        ClientsideFunction(namespace='ubo', function_name='update_home_page'),
+        clientside_home_page_outputs,
+        home_page_inputs + [State('category-data', 'data')]
+    )
+else:
+    dash_app.callback(home_page_outputs, home_page_inputs, [State('snapshot-slider', 'value')])(update_home_page)
+    dash_app.callback(snapshot_outputs, snapshot_inputs, snapshot_states, prevent_initial_call=True)(update_snapshot)
+    dash_app.clientside_callback(
+        ClientsideFunction(namespace='ubo', function_name='update_home_choropleth'),
+        Output('choropleth', 'figure'),
+        [Input('choropleth-update', 'data'), Input('choropleth-delta', 'data')],
+        [State('choropleth-base', 'data'), State('choropleth', 'figure')]
+    )
+
 if __name__ == "__main__":
     app.run(threaded=True)
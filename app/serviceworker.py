@@ -0,0 +1,301 @@
+import hashlib
+import os
+import re
+
+from flask import render_template_string
+
+from app.responses import CLICK_PROPS
+
+
+# Header telling the service worker the version of the data a response
+# belongs to (see data_version_header in app/routes.py)
+DATA_VERSION_HEADER = 'X-UBO-Data-Version'
+
+# Paths of files whose name or query string changes with their content (or
+# which only change with the code, like the Dash bundles), which the service
+# worker serves from its cache without asking the server
+IMMUTABLE_PREFIXES = ['/_dash-component-suites/', '/assets/', '/static/embed/']
+
+# Paths of files whose name contains a hash of their content but which belong
+# to a data version (the geometry and the images of the maps), so they are
+# kept with the data and removed along with it
+DATA_PREFIXES = ['/static/geo/', '/static/maps/']
+
+# Files which the components load on demand and which the pages always need,
+# i.e. dcc.Graph and its Plotly bundle
+ASYNC_BUNDLES = [
+    '/_dash-component-suites/dash_core_components/async-graph.js',
+    '/_dash-component-suites/dash_core_components/async-plotlyjs.js',
+]
+
+# Origins of the fonts loaded by the stylesheets, cached like the bundles
+FONT_ORIGINS = ['https://fonts.gstatic.com']
+
+
+# The scripts, stylesheets and icons an index page of Dash refers to, which
+# the service worker fetches when it is installed, so the next visits load
+# them from its cache; the images of the maps belong to the data and are left
+# out
+def precache_urls(index_html):
+    urls = re.findall(r'<(?:script|link)\b[^>]*\b(?:src|href)="([^"]+)"', index_html)
+    return [url for url in dict.fromkeys(urls) if not any(url.startswith(x) for x in DATA_PREFIXES)] + ASYNC_BUNDLES
+
+
+# Version of the precached files: their URLs, and for files in the static
+# directory (whose URLs don't change with their content, e.g. /static/dash.css)
+# their content too. A new version makes the browser install the service
+# worker again, which replaces the cached files.
+def precache_version(urls, static_folder, static_url_path='/static/'):
+    sha1 = hashlib.sha1('\n'.join(urls).encode('utf-8'))
+    for url in urls:
+        if url.startswith(static_url_path):
+            path = os.path.join(static_folder, url[len(static_url_path):].split('?')[0])
+            if os.path.isfile(path):
+                with open(path, 'rb') as IN:
+                    sha1.update(IN.read())
+    return sha1.hexdigest()[:12]
+
+
+# The service worker of the atlas. It keeps two caches:
+#
+# - 'ubo-static-<version>': the Dash bundles, stylesheets, fonts and icons,
+#   fetched when it is installed and served without asking the server until
+#   a new service worker (see precache_version) replaces the cache.
+# - 'ubo-data-<data version>': the pages, the Dash layout and dependencies,
+#   the responses of the callbacks (keyed by a hash of their request body
+#   without the click counts of the buttons, like in the ResponseCache of
+#   app/responses.py, as the Cache API can't store POST requests and the
+#   counts grow with every click) and the geometry and images of
+#   the maps, for the data version in the DATA_VERSION_HEADER of the
+#   responses. Callbacks and files are served from this cache, so switching
+#   categories needs no requests once a category has been shown. Pages,
+#   layout and dependencies always go to the server first (which answers with
+#   a 304 when nothing changed); as soon as one of them carries a new data
+#   version, the cache of the previous version is dropped, so the figures of
+#   different versions are never mixed. Without a network everything is
+#   served from the caches; pages which weren't visited get the cached home
+#   page, as all pages of Dash are the same page routed in the browser.
+SERVICE_WORKER_TEMPLATE = '''// Service worker of the UBO Atlas, see app/serviceworker.py
+var PRECACHE = {{ precache|tojson }};
+var STATIC_CACHE = 'ubo-static-{{ version }}';
+var DATA_CACHE_PREFIX = 'ubo-data-';
+var DATA_VERSION_HEADER = {{ data_version_header|tojson }};
+var UPDATE_COMPONENT_PATH = {{ update_component_path|tojson }};
+var NETWORK_FIRST_PATHS = {{ network_first_paths|tojson }};
+var IMMUTABLE_PREFIXES = {{ immutable_prefixes|tojson }};
+var DATA_PREFIXES = {{ data_prefixes|tojson }};
+var FONT_ORIGINS = {{ font_origins|tojson }};
+var CLICK_PROPS = {{ click_props|tojson }};
+
+// Promise of the name of the data cache of the current data version, null
+// until a response told which version that is
+var dataCache = null;
+
+self.addEventListener('install', function(event) {
+    // A file which can't be fetched (e.g., from a CDN which is down) is
+    // cached when it is first used instead of failing the installation
+    event.waitUntil(caches.open(STATIC_CACHE).then(function(cache) {
+        return Promise.all(PRECACHE.map(function(url) {
+            return cache.add(url).catch(function() {});
+        }));
+    }).then(function() {
+        return self.skipWaiting();
+    }));
+});
+
+self.addEventListener('activate', function(event) {
+    event.waitUntil(deleteCaches(function(name) {
+        return name.indexOf('ubo-static-') === 0 && name !== STATIC_CACHE;
+    }).then(function() {
+        return self.clients.claim();
+    }));
+});
+
+function deleteCaches(filter) {
+    return caches.keys().then(function(names) {
+        return Promise.all(names.filter(filter).map(function(name) {
+            return caches.delete(name);
+        }));
+    });
+}
+
+function startsWithAny(value, prefixes) {
+    return prefixes.some(function(prefix) {
+        return value.indexOf(prefix) === 0;
+    });
+}
+
+function currentDataCache() {
+    if (!dataCache) {
+        dataCache = caches.keys().then(function(names) {
+            return names.filter(function(name) {
+                return name.indexOf(DATA_CACHE_PREFIX) === 0;
+            })[0] || null;
+        });
+    }
+    return dataCache;
+}
+
+// Keep a response in the data cache of its data version, replacing the
+// caches of other versions if that version is new; files served by nginx
+// (which don't tell their version) go to the cache of the current version
+function storeData(key, response) {
+    if (response.status !== 200) {
+        return Promise.resolve();
+    }
+    var version = response.headers.get(DATA_VERSION_HEADER);
+    return currentDataCache().then(function(current) {
+        var name = version ? DATA_CACHE_PREFIX + version : current;
+        if (!name || name === current) {
+            return name;
+        }
+        dataCache = Promise.resolve(name);
+        return deleteCaches(function(other) {
+            return other.indexOf(DATA_CACHE_PREFIX) === 0 && other !== name;
+        }).then(function() {
+            return name;
+        });
+    }).then(function(name) {
+        return name && caches.open(name).then(function(cache) {
+            return cache.put(key, response);
+        });
+    });
+}
+
+function matchData(key) {
+    return currentDataCache().then(function(name) {
+        return name ? caches.open(name).then(function(cache) {
+            return cache.match(key);
+        }) : undefined;
+    });
+}
+
+function fetchAndStore(event, request, key) {
+    return fetch(request).then(function(response) {
+        event.waitUntil(storeData(key, response.clone()));
+        return response;
+    });
+}
+
+function networkFirst(event, fallback) {
+    var request = event.request;
+    return fetchAndStore(event, request, request).catch(function(error) {
+        return matchData(request).then(function(cached) {
+            return cached || (fallback ? matchData(fallback) : undefined);
+        }).then(function(cached) {
+            return cached || Promise.reject(error);
+        });
+    });
+}
+
+function dataFirst(event, request, key) {
+    return matchData(key).then(function(cached) {
+        return cached || fetchAndStore(event, request, key);
+    });
+}
+
+function staticFirst(request) {
+    return caches.open(STATIC_CACHE).then(function(cache) {
+        return cache.match(request).then(function(cached) {
+            return cached || fetch(request).then(function(response) {
+                if (response.status === 200) {
+                    cache.put(request, response.clone());
+                }
+                return response;
+            });
+        });
+    });
+}
+
+// The inputs or state of a callback without the values of the click counts
+// (with wildcards, an input can also be a list of inputs)
+function dropClicks(items) {
+    return (items || []).map(function(item) {
+        if (Array.isArray(item)) {
+            return dropClicks(item);
+        }
+        return CLICK_PROPS.indexOf(item.property) === -1 ? item : {id: item.id, property: item.property};
+    });
+}
+
+// The callbacks only depend on their request and the data version, so their
+// responses are kept by a hash of what decides them: the outputs, the inputs
+// which changed, and the values of the inputs and state except the click
+// counts, which grow with every click
+function callbackResponse(event) {
+    var request = event.request;
+    return request.clone().json().then(function(body) {
+        var key = JSON.stringify([body.output, body.changedPropIds, dropClicks(body.inputs), dropClicks(body.state)]);
+        return crypto.subtle.digest('SHA-1', new TextEncoder().encode(key));
+    }).then(function(digest) {
+        var hex = Array.prototype.map.call(new Uint8Array(digest), function(x) {
+            return ('0' + x.toString(16)).slice(-2);
+        }).join('');
+        return dataFirst(event, request, UPDATE_COMPONENT_PATH + '?body=' + hex);
+    });
+}
+
+self.addEventListener('fetch', function(event) {
+    var request = event.request;
+    var url = new URL(request.url);
+    var sameOrigin = url.origin === self.location.origin;
+    if (request.method === 'POST') {
+        if (sameOrigin && url.pathname === UPDATE_COMPONENT_PATH) {
+            event.respondWith(callbackResponse(event));
+        }
+    } else if (request.method !== 'GET') {
+        return;
+    } else if (request.mode === 'navigate') {
+        event.respondWith(networkFirst(event, '/'));
+    } else if (sameOrigin && NETWORK_FIRST_PATHS.indexOf(url.pathname) !== -1) {
+        event.respondWith(networkFirst(event, null));
+    } else if (sameOrigin && startsWithAny(url.pathname, DATA_PREFIXES)) {
+        event.respondWith(dataFirst(event, request, request));
+    } else if (PRECACHE.indexOf(sameOrigin ? url.pathname + url.search : request.url) !== -1
+               || (sameOrigin && startsWithAny(url.pathname, IMMUTABLE_PREFIXES))
+               || FONT_ORIGINS.indexOf(url.origin) !== -1) {
+        event.respondWith(staticFirst(request));
+    }
+});
+'''
+
+
+# Served instead when the service worker is disabled: removes the caches and
+# unregisters itself, so browsers which installed it go back to the network
+UNREGISTER_TEMPLATE = '''// Service worker of the UBO Atlas (disabled), see app/serviceworker.py
+self.addEventListener('install', function() {
+    self.skipWaiting();
+});
+
+self.addEventListener('activate', function(event) {
+    event.waitUntil(caches.keys().then(function(names) {
+        return Promise.all(names.filter(function(name) {
+            return name.indexOf('ubo-') === 0;
+        }).map(function(name) {
+            return caches.delete(name);
+        }));
+    }).then(function() {
+        return self.registration.unregister();
+    }));
+});
+'''
+
+
+# Render the service worker for the files an index page refers to;
+# 'network_first_paths' are the paths of the Dash layout and dependencies
+def render_service_worker(index_html, static_folder, update_component_path, network_first_paths, enabled=True):
+    if not enabled:
+        return UNREGISTER_TEMPLATE
+    precache = precache_urls(index_html)
+    return render_template_string(
+        SERVICE_WORKER_TEMPLATE,
+        precache=precache,
+        version=precache_version(precache, static_folder),
+        data_version_header=DATA_VERSION_HEADER,
+        update_component_path=update_component_path,
+        network_first_paths=network_first_paths,
+        immutable_prefixes=IMMUTABLE_PREFIXES,
+        data_prefixes=DATA_PREFIXES,
+        font_origins=FONT_ORIGINS,
+        click_props=CLICK_PROPS
+    )
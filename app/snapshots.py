@@ -0,0 +1,114 @@
+import json
+
+from app.files import atomic_write
+
+
+# Every version of the data shown in the atlas, written by `flask
+# compile-data`; unlike the files in data/build this is the history of the
+# data, so keep it
+SNAPSHOTS_FILE = 'data/snapshots.json'
+
+# Result and status shown for the countries in a snapshot of a category which
+# didn't exist yet at the time
+NO_DATA = 'no data'
+
+
+# The compiled datasets (see compile_dataset in app/dataset.py) of all
+# snapshots in a history file, oldest first, as (date, compiled) pairs.
+# The file holds a list of snapshots: the first one, and any whose countries
+# differ from the previous one, contain all results; the others only the
+# results which changed since the previous snapshot, as lists of [country
+# position, result, status, tooltip] per category, and the titles of the
+# categories which were removed.
+def load_snapshots(path=SNAPSHOTS_FILE):
+    try:
+        with open(path) as IN:
+            entries = json.load(IN)
+    except FileNotFoundError:
+        return []
+
+    snapshots = []
+    compiled = None
+    for entry in entries:
+        if 'countries' in entry:
+            compiled = {'countries': entry['countries'], 'categories': entry['categories']}
+        else:
+            categories = {x['title']: x for x in compiled['categories'] if x['title'] not in entry.get('removed', [])}
+            for title, changes in entry['changes'].items():
+                category = categories.get(title)
+                if category is None:
+                    size = len(compiled['countries'])
+                    category = {'title': title, 'values': [None] * size, 'status': [None] * size, 'tooltips': [None] * size}
+                else:
+                    category = {key: list(value) if isinstance(value, list) else value for key, value in category.items()}
+                for i, value, status, tooltip in changes:
+                    category['values'][i] = value
+                    category['status'][i] = status
+                    category['tooltips'][i] = tooltip
+                categories[title] = category
+            compiled = {'countries': compiled['countries'], 'categories': list(categories.values())}
+        compiled = dict(compiled, version=entry['version'])
+        snapshots.append((entry['date'], compiled))
+    return snapshots
+
+
+# The entry of the history file storing a dataset, relative to the dataset of
+# the previous snapshot (if any)
+def snapshot_entry(compiled, date, previous=None):
+    entry = {'version': compiled['version'], 'date': date}
+    if previous is None or previous['countries'] != compiled['countries']:
+        entry['countries'] = compiled['countries']
+        entry['categories'] = [
+            {key: category[key] for key in ('title', 'values', 'status', 'tooltips')} for category in compiled['categories']
+        ]
+        return entry
+
+    old = {x['title']: x for x in previous['categories']}
+    entry['changes'] = {}
+    for category in compiled['categories']:
+        before = old.get(category['title'])
+        changes = [
+            [i, value, status, tooltip]
+            for i, (value, status, tooltip) in enumerate(zip(category['values'], category['status'], category['tooltips']))
+            if before is None or (before['values'][i], before['status'][i], before['tooltips'][i]) != (value, status, tooltip)
+        ]
+        if changes:
+            entry['changes'][category['title']] = changes
+    titles = {x['title'] for x in compiled['categories']}
+    removed = [title for title in old if title not in titles]
+    if removed:
+        entry['removed'] = removed
+    return entry
+
+
+# Add a compiled dataset to the history file as a snapshot of the given date
+# (e.g., '2021-06-30'), unless it is the same as the latest snapshot; returns
+# whether it was added
+def append_snapshot(compiled, date, path=SNAPSHOTS_FILE):
+    try:
+        with open(path) as IN:
+            entries = json.load(IN)
+    except FileNotFoundError:
+        entries = []
+    if entries and entries[-1]['version'] == compiled['version']:
+        return False
+
+    snapshots = load_snapshots(path)
+    entries.append(snapshot_entry(compiled, date, snapshots[-1][1] if snapshots else None))
+    atomic_write(path, json.dumps(entries, separators=(',', ':')))
+    return True
+
+
+# A compiled snapshot with its categories in the order of the current
+# category definitions, so figures can be built from it like from the current
+# data; categories which didn't exist yet show NO_DATA with status 0
+def align_categories(compiled, categories):
+    by_title = {x['title']: x for x in compiled['categories']}
+    size = len(compiled['countries'])
+    aligned = []
+    for category in categories:
+        snapshot = by_title.get(category['title'])
+        if snapshot is None:
+            snapshot = {'title': category['title'], 'values': [NO_DATA] * size, 'status': [0] * size, 'tooltips': [''] * size}
+        aligned.append(snapshot)
+    return dict(compiled, categories=aligned)
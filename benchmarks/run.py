@@ -0,0 +1,305 @@
+#/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Benchmarks of the atlas, run offline against the Flask app from the root of
+# the project:
+#
+#   python benchmarks/run.py                  # compare with the baseline
+#   python benchmarks/run.py --save-baseline  # store the results as baseline
+#
+# Measures the cold import time of app.routes, the time the warm-up takes,
+# the latency and size of the responses of the Dash endpoints and the embed
+# pages and the latency of a sequence of clicks in the category menu (using
+# the test client), the throughput of a local server with multiple worker
+# processes under concurrent clients and the memory used per worker. The
+# results are written as JSON and compared with the baseline; the exit code
+# is 1 if there is no baseline, if the size of a response regressed or if a
+# category switch response is larger than the budget. Timings, throughput and
+# memory depend on the machine (and the baseline in the repository was saved
+# on one), so their regressions are only reported, unless --strict is given;
+# regenerate the baseline with --save-baseline on the machine the benchmark
+# runs on before relying on them.
+import argparse
+import gzip
+import json
+import logging
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(ROOT, 'benchmarks')
+
+# How much worse than the baseline a metric may get before it counts as a
+# regression, per type of metric
+TOLERANCES = {
+    'bytes': 0.05,
+    'seconds': 0.25,
+    'requests_per_second': 0.25,
+    'kb': 0.15,
+}
+
+# Types of metrics which depend on the machine the benchmark runs on
+MACHINE_DEPENDENT = {'seconds', 'requests_per_second', 'kb'}
+
+# Changes in latency smaller than this (in seconds) are noise, not regressions
+MIN_SECONDS_CHANGE = 0.001
+
+
+# Time a fresh interpreter needs to import app.routes (which also creates the
+# Flask and Dash apps and loads the data)
+def measure_import_time(repeat):
+    code = 'import time; t = time.perf_counter(); import app.routes; print(time.perf_counter() - t)'
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, env=dict(os.environ, UBO_DATA_RELOAD_INTERVAL='0'))
+        times.append(float(output.decode().strip().splitlines()[-1]))
+    return {'import app.routes': {'seconds': min(times)}}
+
+
+# Latency and response size of every request the pages make to the Dash
+# endpoints; the first request is measured separately as it fills the caches
+def measure_endpoints(app, dash_requests, repeat):
+    client = app.test_client()
+    results = {}
+    for name, method, path, body in dash_requests:
+        times = []
+        for _ in range(repeat + 1):
+            start = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            times.append(time.perf_counter() - start)
+            assert response.status_code == 200, f'{name}: {response.status_code}'
+        data = response.get_data()
+        results[name] = {
+            'first_seconds': times[0],
+            'median_seconds': statistics.median(times[1:]),
+            'p95_seconds': sorted(times[1:])[int(0.95 * (len(times) - 2))],
+            'bytes': len(data),
+            'gzip_bytes': len(gzip.compress(data)),
+        }
+    return results
+
+
+# Latency of a visitor clicking through the category menu, whose requests
+# differ in the click counts (unlike the repeated requests measured by
+# measure_endpoints), and how many of them the response cache answered
+def measure_clicks(app, click_requests):
+    from app import routes
+    client = app.test_client()
+    hits = routes.response_cache.hits
+    times = []
+    for name, method, path, body in click_requests:
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body, headers={'Accept-Encoding': 'br, gzip'})
+        times.append(time.perf_counter() - start)
+        assert response.status_code == 200, f'{name}: {response.status_code}'
+    return {'click sequence': {
+        'median_seconds': statistics.median(times),
+        'p95_seconds': sorted(times)[int(0.95 * (len(times) - 1))],
+        'response_cache_hits': routes.response_cache.hits - hits,
+        'requests': len(times),
+    }}
+
+
+# Serve the app on a local port with several worker processes forked from this
+# process (after the app has been loaded, like uWSGI does)
+def start_server(app, workers):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    port = sock.getsockname()[1]
+
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                make_server('127.0.0.1', port, app, fd=sock.fileno()).serve_forever()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    sock.close()
+    return port, pids
+
+
+def stop_server(pids):
+    for pid in pids:
+        os.kill(pid, 15)
+        os.waitpid(pid, 0)
+
+
+# Requests per second the server handles with 'clients' concurrent clients,
+# each repeatedly making all requests of the pages
+def measure_throughput(port, dash_requests, clients, duration):
+    counts = [0] * clients
+    errors = [0] * clients
+    stop = time.perf_counter() + duration
+
+    def run(i):
+        while time.perf_counter() < stop:
+            for name, method, path, body in dash_requests:
+                request = urllib.request.Request(
+                    f'http://127.0.0.1:{port}{path}',
+                    method=method,
+                    data=json.dumps(body).encode('utf-8') if body else None,
+                    headers={'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'}
+                )
+                try:
+                    with urllib.request.urlopen(request) as response:
+                        response.read()
+                    counts[i] += 1
+                except Exception:
+                    errors[i] += 1
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {'throughput': {'requests_per_second': sum(counts) / elapsed, 'errors': sum(errors)}}
+
+
+# Resident (RSS) and proportional (PSS, i.e. with shared pages divided over
+# the processes sharing them) memory of each worker; Linux only
+def measure_memory(pids):
+    rss, pss = [], []
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as IN:
+                values = dict(line.split(':', 1) for line in IN if ':' in line and not line.startswith(' '))
+        except OSError:
+            return {}
+        rss.append(int(values['Rss'].split()[0]))
+        pss.append(int(values['Pss'].split()[0]))
+    return {'memory per worker': {'rss_kb': statistics.mean(rss), 'pss_kb': statistics.mean(pss)}}
+
+
+# Unit of a metric, which determines its tolerance and whether higher is
+# better
+def metric_type(metric):
+    for unit in TOLERANCES:
+        if metric.endswith(unit):
+            return unit
+    return None
+
+
+# List the metrics which are worse than in the baseline by more than their
+# tolerance, and the callbacks whose responses exceed the size budget, as
+# the regressions which fail the benchmark and those which depend on the
+# machine
+def compare(results, baseline, callback_budget):
+    regressions = []
+    machine_regressions = []
+    for name, metrics in results.items():
+        if name.startswith('update_home_page') and callback_budget and metrics['bytes'] > callback_budget:
+            regressions.append(f"{name} bytes: {metrics['bytes']} exceeds the budget of {callback_budget}")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            unit = metric_type(metric)
+            base = baseline.get(name, {}).get(metric)
+            if unit is None or not base:
+                continue
+            if unit == 'seconds' and value - base < MIN_SECONDS_CHANGE:
+                continue
+            change = (value - base) / base
+            if unit == 'requests_per_second':
+                change = -change
+            if change > TOLERANCES[unit]:
+                regression = f'{name} {metric}: {base:.6g} -> {value:.6g} ({change:+.0%})'
+                (machine_regressions if unit in MACHINE_DEPENDENT else regressions).append(regression)
+    return regressions, machine_regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the UBO Atlas app.')
+    parser.add_argument('--repeat', type=int, default=50, help='requests per endpoint')
+    parser.add_argument('--clicks', type=int, default=100, help='clicks in the category menu')
+    parser.add_argument('--imports', type=int, default=3, help='number of cold imports')
+    parser.add_argument('--workers', type=int, default=4, help='server worker processes')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=5, help='seconds of load')
+    parser.add_argument('--output', default=os.path.join(BENCHMARK_DIR, 'results.json'))
+    parser.add_argument('--baseline', default=os.path.join(BENCHMARK_DIR, 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as baseline')
+    parser.add_argument(
+        '--strict', action='store_true',
+        help='also fail on regressions of timings, throughput and memory (with a baseline from this machine)'
+    )
+    parser.add_argument(
+        '--callback-budget', type=int, default=50000,
+        help='maximum size in bytes of a category switch response, 0 to disable (e.g., with UBO_GEOJSON_MODE=inline)'
+    )
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    os.environ['UBO_DATA_RELOAD_INTERVAL'] = '0'
+    # Don't share the metrics directory of a server running on this machine,
+    # which preloading would clear
+    os.environ['UBO_METRICS_DIR'] = ''
+
+    baseline = None
+    if not args.save_baseline:
+        if not os.path.exists(args.baseline):
+            sys.exit(f'No baseline at {args.baseline}, run with --save-baseline to store one')
+        with open(args.baseline) as IN:
+            baseline = json.load(IN)
+
+    results = measure_import_time(args.imports)
+
+    from app import app, preload
+    from app.client import click_requests, dash_requests, embed_requests, home_page_on_server
+    requests = dash_requests() + embed_requests()
+
+    # Fork the workers right after loading (and, unless UBO_PRELOAD=0,
+    # preloading) the app, before this process has handled any requests, like
+    # uWSGI does
+    if app.config['UBO_PRELOAD']:
+        preload.preload()
+        results['warm up'] = {'seconds': preload.warm_up_seconds}
+    port, pids = start_server(app, args.workers)
+    try:
+        results.update(measure_throughput(port, requests, args.clients, args.duration))
+        results.update(measure_memory(pids))
+    finally:
+        stop_server(pids)
+
+    results.update(measure_endpoints(app, requests, args.repeat))
+    if home_page_on_server():
+        results.update(measure_clicks(app, click_requests(args.clicks)))
+
+    with open(args.output, 'w') as OUT:
+        json.dump(results, OUT, indent=2, sort_keys=True)
+    for name, metrics in results.items():
+        print(f"{name:<28} " + '  '.join(f'{metric}={value:.6g}' for metric, value in sorted(metrics.items())))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as OUT:
+            json.dump(results, OUT, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+    else:
+        regressions, machine_regressions = compare(results, baseline, args.callback_budget)
+        if args.strict:
+            regressions += machine_regressions
+        elif machine_regressions:
+            print('Slower or larger than the baseline, which may be another machine (use --strict to fail):')
+            print('\n'.join(f'- {x}' for x in machine_regressions))
+        if regressions:
+            print('Regressions compared to the baseline:')
+            print('\n'.join(f'- {x}' for x in regressions))
+            sys.exit(1)
+        print('No regressions compared to the baseline')
+
+
+if __name__ == "__main__":
+    main()
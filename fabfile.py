@@ -26,5 +26,15 @@ def deploy(c):
         )
     )
 
+    # Validate and compile the data
+    c.sudo('docker exec ubo_app_1 flask compile-data')
+
+    # Build the optimized geometry of the map
+    c.sudo('docker exec ubo_app_1 flask build-geometry')
+
+    # Render the images of the maps (requires kaleido, the deploy continues
+    # without them)
+    c.sudo('docker exec ubo_app_1 flask render-maps', warn=True)
+
     # Reload app
     c.run('bash -c "cd %s && touch uwsgi-touch-reload"' % (DIR))
@@ -0,0 +1,15 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The app reads its settings from the environment and its data from paths
+# relative to the root of the project when it is imported
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+os.environ['UBO_GEOJSON_MODE'] = 'asset'
+os.environ['UBO_CALLBACK_ENGINE'] = 'server'
+os.environ['UBO_DATA_RELOAD_INTERVAL'] = '0'
+os.environ['UBO_METRICS_DIR'] = ''
+# Two atlases next to the UBO atlas (see app/atlas.py), using its data
+os.environ['UBO_ATLASES'] = os.path.join(ROOT, 'tests', 'atlases.json')
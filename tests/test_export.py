@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from app import routes
+from app.cache import to_json
+from app.dataset import Dataset, compile_dataset
+from app.export import export_site, exported_category_data
+from app.figures import category_figure
+
+# Shows the figures of the exported home page the way the browser does: runs
+# the clientside update_home_page of app/assets/clientside.js on a desktop
+# screen for the start page and a click on every category, and prints them
+CLIENTSIDE_SCRIPT = '''
+var fs = require('fs');
+global.window = global;
+window.matchMedia = function() { return {matches: false}; };
+eval(fs.readFileSync(process.argv[1], 'utf8'));
+var data = JSON.parse(fs.readFileSync(0, 'utf8'));
+var figures = {};
+['start'].concat(data.categories.map(function(_, i) { return i; })).forEach(function(key) {
+    var clicks = data.categories.map(function(_, i) { return i === key ? 1 : null; });
+    dash_clientside.callback_context = {triggered: key === 'start' ? [] : [{prop_id: 'group-' + key + '-toggle.n_clicks', value: 1}]};
+    figures[key] = dash_clientside.ubo.update_home_page.apply(null, clicks.concat([data]))[0];
+});
+console.log(JSON.stringify(figures));
+'''
+
+
+# The figures of the current CSVs, built from the data without any of the
+# caches of app/routes.py
+def expected_figures():
+    dataset = Dataset(compile_dataset(routes.DATA_FILE, routes.DATA_TOOLTIPS_FILE, routes.DATA_FIELDS_FILE, routes.ubo_info))
+    figures = {'start': routes.build_choropleth('start')}
+    for i in range(0, len(routes.ubo_info)):
+        figures[str(i)] = category_figure(dataset, i, routes.geojson, routes.color_map, routes.LAT_RANGE, routes.LON_RANGE)
+    return json.loads(to_json(figures))
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='requires node')
+def test_exported_home_page_shows_the_data(tmp_path):
+    export_dir = str(tmp_path / 'export')
+    manifest = export_site(export_dir)
+    data = exported_category_data(manifest, export_dir)
+
+    output = subprocess.check_output(
+        ['node', '-e', CLIENTSIDE_SCRIPT, os.path.join(routes.app.root_path, 'assets', 'clientside.js')],
+        input=json.dumps(data).encode('utf-8')
+    )
+    shown = json.loads(output)
+    expected = expected_figures()
+    assert sorted(shown) == sorted(expected)
+    for key, figure in expected.items():
+        assert shown[key] == figure, key
@@ -0,0 +1,15 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+# Modules which are slow to import and which a worker doesn't need
+SLOW_MODULES = ['plotly.offline', 'plotly.graph_objs', 'IPython']
+
+
+def test_routes_skip_slow_modules():
+    code = 'import sys, app.routes; print(" ".join(x for x in %r if x in sys.modules))' % SLOW_MODULES
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, env=dict(os.environ))
+    assert output.decode().strip() == ''
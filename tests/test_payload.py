@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from app import app, routes
+from app.client import UPDATE_COMPONENT_PATH, home_page_body, snapshot_body
+
+# Maximum size in bytes of the (uncompressed) response to a click in the
+# category menu; with the geometry served as a static file it only contains
+# the values of the category
+CATEGORY_SWITCH_BUDGET = 8 * 1024
+
+
+@pytest.mark.parametrize('key', range(0, len(routes.ubo_info)))
+def test_category_switch_response_is_small(key):
+    response = app.test_client().post(UPDATE_COMPONENT_PATH, json=home_page_body(key))
+    assert response.status_code == 200
+    body = response.get_data()
+    assert len(body) < CATEGORY_SWITCH_BUDGET
+
+    # Only the values which differ between the categories, without the
+    # geometry or the layout
+    update = json.loads(body)['response']['choropleth-update']['data']
+    assert set(update['trace']) == set(routes.CATEGORY_TRACE_KEYS)
+
+
+# Positions of the time slider which aren't one of its snapshots, as a client
+# could send them
+INVALID_SNAPSHOTS = ['latest', 1.5, -3, 10 ** 6, None, [0], float('inf')]
+
+
+@pytest.mark.parametrize('snapshot', INVALID_SNAPSHOTS)
+def test_invalid_snapshot_shows_current_data(snapshot):
+    response = app.test_client().post(UPDATE_COMPONENT_PATH, json=home_page_body(0, snapshot=snapshot))
+    assert response.status_code == 200
+    update = json.loads(response.get_data())['response']['choropleth-update']['data']
+    assert update['trace'] == routes.figure_update_cache.get(0)['trace']
+
+
+@pytest.mark.parametrize('snapshot', INVALID_SNAPSHOTS)
+def test_invalid_snapshot_is_ignored(snapshot):
+    latest = len(routes.snapshot_datasets) - 1
+    response = app.test_client().post(UPDATE_COMPONENT_PATH, json=snapshot_body(latest, snapshot, 0))
+    assert response.status_code in (200, 204)
+    if response.status_code == 200:
+        shown = json.loads(response.get_data())['response']['snapshot-shown']['data']
+        assert shown in range(0, latest + 1)
@@ -0,0 +1,45 @@
+import shutil
+
+import pytest
+
+from app import routes
+
+
+# Copies of the CSVs the app reloads from, restored (with the data) afterwards
+@pytest.fixture
+def data_files(tmp_path, monkeypatch):
+    names = {}
+    for name in ('DATA_FILE', 'DATA_TOOLTIPS_FILE', 'DATA_FIELDS_FILE'):
+        names[name] = str(tmp_path / name.lower())
+        shutil.copyfile(getattr(routes, name), names[name])
+        monkeypatch.setattr(routes, name, names[name])
+    yield names
+    monkeypatch.undo()
+    routes.reload_data()
+
+
+def replace(path, old, new):
+    with open(path) as IN:
+        content = IN.read()
+    assert old in content
+    with open(path, 'w') as OUT:
+        OUT.write(content.replace(old, new, 1))
+
+
+# Invalid CSVs are reported and the data in use stays, also when it is newer
+# than the compiled data in data/build
+def test_invalid_data_keeps_the_reloaded_data(data_files):
+    original = routes.dataset.version
+
+    replace(data_files['DATA_FILE'], 'Austria,AUT,implemented,not public,N/A,', 'Austria,AUT,implemented,not public,yes,')
+    routes.reload_data()
+    edited = routes.dataset.version
+    assert edited != original
+    responses_version = routes.responses_version()
+
+    replace(data_files['DATA_FILE'], 'Austria,AUT,implemented,not public,yes,', 'Austria,AUT,implemented,not public,maybe,')
+    routes.reload_data()
+    assert routes.dataset.version == edited
+    assert routes.responses_version() == responses_version
+    paywall = next(i for i, x in enumerate(routes.ubo_info) if x['title'] == 'Paywall')
+    assert routes.dataset.categories[paywall]['values'][routes.dataset.index['AUT']] == 'yes'
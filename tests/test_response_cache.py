@@ -0,0 +1,35 @@
+import pytest
+
+from app import app, routes
+from app.client import UPDATE_COMPONENT_PATH, display_page_body
+
+
+# A request answered from the cache and, with the ETag of the response, a 304
+def assert_cached(cache, path, **kwargs):
+    client = app.test_client()
+    first = client.open(path, **kwargs)
+    assert first.status_code == 200
+    etag = first.headers.get('ETag')
+    assert etag
+
+    hits = cache.hits
+    second = client.open(path, **kwargs)
+    assert second.status_code == 200
+    assert cache.hits == hits + 1
+    assert second.get_data() == first.get_data()
+
+    not_modified = client.open(path, headers={'If-None-Match': etag}, **kwargs)
+    assert not_modified.status_code == 304
+
+
+def test_main_app_is_cached():
+    assert_cached(routes.response_cache, UPDATE_COMPONENT_PATH, method='POST', json=display_page_body('/about'))
+
+
+@pytest.mark.parametrize('path', ['/ubo-a/embed/paywall', '/ubo-a/api/v1/query?paywall=yes'])
+def test_first_atlas_is_cached(path):
+    assert_cached(routes.atlas_response_caches['ubo-a'], path)
+
+
+def test_last_atlas_is_cached():
+    assert_cached(routes.atlas_response_caches['ubo-b'], '/ubo-b/embed/paywall')